@@ -0,0 +1,323 @@
+"""
+Offline end-to-end benchmark for the documentation-feedback pipeline.
+
+Generates a synthetic v1/v2 export with the real column schema, runs
+pipeline.process_file against local OpenAI and Firestore stand-ins with
+configurable latency and error rates, and reports wall time, peak memory,
+API calls per row and Firestore round trips. No credentials are needed.
+
+    python benchmark.py --rows 500 --latency 0.3 --error-rate 0.02
+    python benchmark.py --rows 150 --mode combined --repeat 3 --json
+"""
+import argparse
+import contextlib
+import io
+import json
+import random
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import openai
+import pandas as pd
+
+import pipeline
+from metrics import metrics
+
+########################################
+# 1) SYNTHETIC EXPORTS
+########################################
+
+FIRST_NAMES = ["alex", "sam", "jordan", "taylor", "casey", "riley", "morgan", "jamie", "avery", "quinn"]
+DIAGNOSES = ["Bronchiolitis", "Acute otitis media", "Community-acquired pneumonia", "Gastroenteritis", "Kawasaki disease"]
+SENTENCE = "Patient presented with {n} days of fever and cough, decreased oral intake and fussiness at night.  "
+
+def generate_export(rows, version="v2", duplicate_rate=0.1, seed=0):
+    """
+    Builds a DataFrame shaped like a REDCap documentation export for version.
+    About duplicate_rate of the rows are earlier resubmissions of another student.
+    """
+    rng = random.Random(seed)
+    timestamp_col = "documentation_submission_2_timestamp" if version == "v2" else "documentation_submission_1_timestamp"
+    students = max(1, int(rows * (1 - duplicate_rate)))
+    records = []
+    for i in range(rows):
+        student = i if i < students else rng.randrange(students)
+        name = f"{FIRST_NAMES[student % len(FIRST_NAMES)]}{student}"
+        v = lambda field: f"{field}_{version}"
+        records.append({
+            "record_id": str(i + 1),
+            f"email_{version}": f"{name}@med.example.edu",
+            timestamp_col: f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}",
+            v("historyofpresentillness"): SENTENCE.format(n=rng.randint(1, 9)) * rng.randint(3, 12),
+            v("reviewofsystems"): "Positive for fever, cough.  Negative for rash, vomiting.",
+            v("age"): str(rng.randint(1, 84)),
+            v("pmhx"): "None", v("pshx"): "None", v("famhx"): "Asthma in father",
+            v("diet"): "Formula, 4 oz every 3 hours", v("birthhx"): "Term, SVD", v("dev"): "Meeting milestones",
+            v("soc_hx_features"): "Lives with parents, daycare", v("med"): "None", v("all"): "NKDA",
+            v("imm"): "Up to date",
+            v("temp"): f"{rng.uniform(36.5, 40):.1f}", v("hr"): str(rng.randint(90, 180)), v("rr"): str(rng.randint(20, 60)),
+            v("pulseox"): str(rng.randint(88, 100)), v("sbp"): str(rng.randint(80, 110)), v("dbp"): str(rng.randint(40, 70)),
+            v("weight"): f"{rng.uniform(3, 40):.1f}", v("weighttile"): f"{rng.randint(1, 99)}th",
+            v("height"): f"{rng.uniform(50, 150):.1f}", v("heighttile"): f"{rng.randint(1, 99)}th",
+            v("bmi"): f"{rng.uniform(12, 25):.1f}", v("bmitile"): f"{rng.randint(1, 99)}th",
+            v("physicalexam"): "General: Tired but consolable.  Lungs: Diffuse crackles.  Abdomen: Soft.",
+            v("dxs"): "CBC, CRP, chest x-ray",
+            v("mostlikelydiagnosis"): rng.choice(DIAGNOSES), v("mostlikelydiagnosisj"): "Fever, cough, crackles",
+            v("seclikelydiagnosis"): rng.choice(DIAGNOSES), v("seclikelydiagnosisj"): "Fever",
+            v("thirlikelydiagnosis"): rng.choice(DIAGNOSES), v("thirlikelydiagnosisj"): "Cough",
+        })
+    return pd.DataFrame(records)
+
+########################################
+# 2) LOCAL STAND-INS
+########################################
+
+class _Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def add(self, n=1):
+        with self._lock:
+            self.value += n
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+class FakeDocument:
+    def __init__(self, db, collection, doc_id):
+        self._db, self._collection, self.id = db, collection, doc_id
+        self.path = f"{collection}/{doc_id}"
+
+    def get(self):
+        self._db.round_trip()
+        return FakeSnapshot(self.id, self._db.docs(self._collection).get(self.id))
+
+    def set(self, data, merge=False):
+        self._db.round_trip()
+        self._db.write(self._collection, self.id, data, merge)
+
+class FakeCollection:
+    def __init__(self, db, name):
+        self._db, self.name = db, name
+
+    def document(self, doc_id):
+        return FakeDocument(self._db, self.name, doc_id)
+
+    def stream(self):
+        self._db.round_trip()
+        return [FakeSnapshot(doc_id, data) for doc_id, data in list(self._db.docs(self.name).items())]
+
+class FakeBatch:
+    def __init__(self, db):
+        self._db, self._writes = db, []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append((ref, data, merge))
+
+    def commit(self):
+        self._db.round_trip()
+        for ref, data, merge in self._writes:
+            self._db.write(ref._collection, ref.id, data, merge)
+
+class FakeFirestore:
+    """In-memory Firestore stand-in; every get/set/get_all/commit/stream costs one round trip of latency."""
+
+    def __init__(self, latency=0.02):
+        self.latency = latency
+        self.round_trips = _Counter()
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def round_trip(self):
+        self.round_trips.add()
+        time.sleep(self.latency)
+
+    def docs(self, collection):
+        with self._lock:
+            return self._data.setdefault(collection, {})
+
+    def write(self, collection, doc_id, data, merge):
+        with self._lock:
+            docs = self._data.setdefault(collection, {})
+            if merge and doc_id in docs:
+                docs[doc_id].update(data)
+            else:
+                docs[doc_id] = dict(data)
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def get_all(self, refs, field_paths=None):
+        self.round_trip()
+        snapshots = []
+        for ref in refs:
+            data = self.docs(ref._collection).get(ref.id)
+            if data is not None and field_paths is not None:
+                data = {key: value for key, value in data.items() if key in field_paths}
+            snapshots.append(FakeSnapshot(ref.id, data))
+        return snapshots
+
+    def batch(self):
+        return FakeBatch(self)
+
+class FakeChatCompletion:
+    """
+    Stand-in for openai.ChatCompletion.create with log-normal latency around
+    `latency` seconds and RateLimitError raised at `error_rate`.
+    """
+
+    def __init__(self, latency=0.5, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = _Counter()
+        self.errors = _Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def create(self, model, messages, max_tokens, **kwargs):
+        self.calls.add()
+        with self._lock:
+            delay = self.latency * self._rng.lognormvariate(0, 0.25)
+            fail = self._rng.random() < self.error_rate
+        time.sleep(delay)
+        if fail:
+            self.errors.add()
+            raise openai.error.RateLimitError("synthetic rate limit")
+        prompt = messages[0]["content"]
+        if "JSON object" in prompt:
+            content = json.dumps({key: f"Synthetic {key} feedback." for key in pipeline.COMBINED_SECTIONS})
+        else:
+            content = "Synthetic feedback: 1) onset 2) severity 3) pertinent negatives."
+        return {
+            "choices": [{"message": {"content": content}}],
+            "usage": {"prompt_tokens": pipeline.count_tokens(prompt), "completion_tokens": 20},
+        }
+
+@contextlib.contextmanager
+def patched_openai(fake):
+    original = openai.ChatCompletion.create
+    openai.ChatCompletion.create = fake.create
+    try:
+        yield
+    finally:
+        openai.ChatCompletion.create = original
+
+########################################
+# 3) RUNNER
+########################################
+
+def run_once(args, seed):
+    """Runs one end-to-end pass in fresh temp cache/journal dirs and returns its measurements."""
+    export = generate_export(args.rows, args.version, args.duplicate_rate, seed).to_csv(index=False).encode("utf-8")
+    fake_db = FakeFirestore(args.firestore_latency)
+    fake_openai = FakeChatCompletion(args.latency, args.error_rate, seed)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        pipeline.configure({
+            "processing": {
+                "max_concurrency": args.concurrency,
+                "analysis_mode": args.mode,
+                "retry_base_delay": args.retry_base_delay,
+            },
+            "cache": {
+                "enabled": args.cache,
+                "path": f"{workdir}/responses.sqlite3",
+                "journal_dir": f"{workdir}/journals",
+            },
+            "limits": {"requests_per_minute": 0, "tokens_per_minute": 0},
+        })
+        pipeline.set_db(fake_db)
+
+        metrics.reset()
+        with patched_openai(fake_openai):
+            tracemalloc.start()
+            started = time.perf_counter()
+            if args.chunksize:
+                source, output = io.BytesIO(export), f"{workdir}/output.csv"
+                result = pipeline.process_file_chunked(source, output, args.chunksize, mode=args.mode)
+            else:
+                result = pipeline.process_file(export, mode=args.mode)
+            wall = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        if result is not None and args.chunksize:
+            result = (pd.read_csv(output, dtype=str, keep_default_na=False), result[1])
+
+        # Rebuilding the export from the results store: no API calls at all
+        round_trips = fake_db.round_trips.value
+        started = time.perf_counter()
+        exported = pipeline.load_results(args.version)
+        export_wall = time.perf_counter() - started
+        export_round_trips = fake_db.round_trips.value - round_trips
+
+    out_rows = 0 if result is None else len(result[0])
+    failed = 0 if result is None else int((result[0][f"ai_errors_{args.version}"] != "").sum())
+    return {
+        "rows_in": args.rows,
+        "rows_out": out_rows,
+        "failed_rows": failed,
+        "wall_seconds": round(wall, 3),
+        "rows_per_minute": round(out_rows / wall * 60, 1) if wall else 0.0,
+        "peak_memory_mb": round(peak / 2**20, 2),
+        "api_calls": fake_openai.calls.value,
+        "api_errors": fake_openai.errors.value,
+        "api_calls_per_row": round(fake_openai.calls.value / out_rows, 2) if out_rows else 0.0,
+        "firestore_round_trips": round_trips,
+        "export_rows": len(exported),
+        "export_seconds": round(export_wall, 3),
+        "export_round_trips": export_round_trips,
+        "stage_seconds": {name: stage["seconds"] for name, stage in metrics.snapshot()["stages"].items()},
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline offline against local stand-ins.")
+    parser.add_argument("--rows", type=int, default=150, help="rows in the synthetic export (default: 150)")
+    parser.add_argument("--version", choices=["v1", "v2"], default="v2")
+    parser.add_argument("--duplicate-rate", type=float, default=0.1, help="share of rows that are resubmissions")
+    parser.add_argument("--mode", choices=["separate", "combined"], default="separate")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.5, help="median fake OpenAI latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fake OpenAI rate-limit error rate")
+    parser.add_argument("--firestore-latency", type=float, default=0.02, help="fake Firestore round-trip seconds")
+    parser.add_argument("--retry-base-delay", type=float, default=0.05, help="retry backoff base in seconds")
+    parser.add_argument("--cache", action="store_true", help="enable the response cache (fresh per repeat)")
+    parser.add_argument("--chunksize", type=int, default=0, help="use chunked ingestion with this many rows per chunk")
+    parser.add_argument("--repeat", type=int, default=1, help="independent runs to aggregate")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    runs = [run_once(args, seed) for seed in range(args.repeat)]
+
+    if args.json:
+        print(json.dumps({"config": vars(args), "runs": runs}, indent=2))
+        return
+
+    print(f"{args.rows} rows, {args.version}, mode={args.mode}, concurrency={args.concurrency}, "
+          f"latency={args.latency}s, error_rate={args.error_rate}")
+    for key in runs[0]:
+        if key == "stage_seconds":
+            continue
+        values = [run[key] for run in runs]
+        if len(values) > 1:
+            print(f"  {key:<22} median {statistics.median(values):>10}   min {min(values):>10}   max {max(values):>10}")
+        else:
+            print(f"  {key:<22} {values[0]:>10}")
+    print("  stage seconds (first run):")
+    for name, seconds in runs[0]["stage_seconds"].items():
+        print(f"    {name:<24} {seconds:>8}")
+
+if __name__ == "__main__":
+    main()
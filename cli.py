@@ -0,0 +1,200 @@
+"""
+Headless batch runner for the documentation-feedback pipeline.
+
+    python cli.py exports/*.csv --output-dir processed --format xlsx
+    python cli.py "exports/**/*.csv" --jobs 3 --concurrency 16
+    python cli.py rotation.csv --dry-run
+    python cli.py big_export.csv --chunksize 2000
+    python cli.py --export-stored v2 --since 2024-08-01 --format xlsx
+
+Settings and credentials come from .streamlit/secrets.toml (or --secrets);
+OPENAI_API_KEY in the environment overrides [openai] api_key.
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import pipeline
+from metrics import metrics
+
+logger = logging.getLogger("docsub.cli")
+
+def expand_inputs(patterns):
+    """Expands globs (quoted patterns included) into a de-duplicated, ordered list of files."""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        paths.extend(matches)
+    return list(dict.fromkeys(paths))
+
+def output_path(input_path, output_dir, version, fmt):
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(output_dir, f"{stem}_processed_{version}.{fmt}")
+
+def run_one_chunked(path, args):
+    """
+    run_one for --chunksize: streams the CSV through the pipeline, appending to a CSV
+    that is then re-encoded chunk by chunk when another --format is asked for.
+    """
+    try:
+        prepared = pipeline.prepare_chunked_upload(path, args.chunksize)
+    except (OSError, pipeline.PipelineError) as exc:
+        logger.error("%s: %s", path, exc)
+        return False
+    if prepared is None:
+        logger.info("%s: all record_ids have already been processed", path)
+        return True
+
+    projection = pipeline.estimate_chunked_cost(prepared, args.mode)
+    logger.info(
+        "%s: %d record(s) in chunks of %d, %d request(s), %d prompt tokens, at most $%.2f",
+        path, len(prepared.rows), prepared.chunksize,
+        projection["requests"], projection["prompt_tokens"], projection["max_cost_usd"],
+    )
+    if args.dry_run:
+        return True
+    if pipeline.over_budget(projection):
+        logger.error("%s: projected cost exceeds the run budget of $%.2f; skipped", path, pipeline.RUN_BUDGET_USD)
+        return False
+
+    destination = output_path(path, args.output_dir, prepared.version, "csv")
+    written = failed = 0
+    for done, total, written, failed in pipeline.iter_chunked_upload(
+        prepared, destination, mode=args.mode, max_workers=args.concurrency
+    ):
+        logger.info("%s: %d/%d record(s) done, %d written", path, done, total, written)
+    if not written:
+        logger.info("%s: no resubmission changed since it was processed", path)
+        return True
+    if args.format != "csv":
+        csv_destination = destination
+        destination = output_path(path, args.output_dir, prepared.version, args.format)
+        pipeline.convert_output(csv_destination, prepared.version, destination, args.format, args.chunksize)
+        os.remove(csv_destination)
+    logger.info("%s: wrote %s (%d record(s) with AI errors)", path, destination, failed)
+    return failed == 0
+
+def run_one(path, args):
+    """Processes one CSV. Returns True on success (including 'nothing to process')."""
+    if args.chunksize:
+        return run_one_chunked(path, args)
+    try:
+        prepared = pipeline.prepare_upload(pipeline.read_source(path))
+    except (OSError, pipeline.PipelineError) as exc:
+        logger.error("%s: %s", path, exc)
+        return False
+    if prepared is None:
+        logger.info("%s: all record_ids have already been processed", path)
+        return True
+    df, version, journal, resumed, reuse = prepared
+
+    projection = pipeline.estimate_run_cost(df, version, args.mode, reuse)
+    logger.info(
+        "%s: %d record(s) (%d resumed, %d resubmitted), %d request(s), %d prompt tokens, at most $%.2f",
+        path, len(df), resumed, len(reuse),
+        projection["requests"], projection["prompt_tokens"], projection["max_cost_usd"],
+    )
+    if args.dry_run:
+        return True
+    if pipeline.over_budget(projection):
+        logger.error("%s: projected cost exceeds the run budget of $%.2f; skipped", path, pipeline.RUN_BUDGET_USD)
+        return False
+
+    df = pipeline.run_ai_analysis(
+        df, version, max_workers=args.concurrency, journal=journal, mode=args.mode, reuse=reuse
+    )
+    failed = pipeline.finalize_upload(df, version, journal)
+
+    destination = output_path(path, args.output_dir, version, args.format)
+    pipeline.write_output(df, version, destination, args.format)
+    logger.info("%s: wrote %s (%d record(s) with AI errors)", path, destination, failed)
+    return failed == 0
+
+def export_stored(args):
+    """Rebuilds an export from the results store; no API calls. Returns True on success."""
+    since = pd.Timestamp(args.since, tz="US/Eastern").to_pydatetime() if args.since else None
+    try:
+        df = pipeline.load_results(args.export_stored, submitted_since=since)
+    except pipeline.PipelineError as exc:
+        logger.error("%s", exc)
+        return False
+    if df.empty:
+        logger.info("No stored %s results%s", args.export_stored, f" since {args.since}" if args.since else "")
+        return True
+    destination = os.path.join(args.output_dir, f"stored_results_{args.export_stored}.{args.format}")
+    pipeline.write_output(df, args.export_stored, destination, args.format)
+    logger.info("Wrote %d stored record(s) to %s", len(df), destination)
+    return True
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate AI documentation feedback for exported CSVs.")
+    parser.add_argument("inputs", nargs="*", help="CSV files or glob patterns")
+    parser.add_argument("-o", "--output-dir", default=".", help="directory for processed files (default: .)")
+    parser.add_argument("-f", "--format", choices=list(pipeline.EXPORT_FORMATS), default="csv",
+                        help="output format (parquet needs pyarrow)")
+    parser.add_argument("--secrets", default=os.path.join(".streamlit", "secrets.toml"), help="secrets.toml path")
+    parser.add_argument("--mode", choices=["separate", "combined"], help="analysis mode (default from secrets)")
+    parser.add_argument("-c", "--concurrency", type=int, help="concurrent API calls per file")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="files processed in parallel (default: 1)")
+    parser.add_argument("--no-cache", action="store_true", help="disable the local response cache")
+    parser.add_argument("--cache-path", help="response cache location")
+    parser.add_argument("--chunksize", type=int,
+                        help="process each file in chunks of this many rows to bound memory")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="dedup and project cost only; no API calls, writes or Firestore marks")
+    parser.add_argument("--export-stored", choices=["v1", "v2"], metavar="VERSION",
+                        help="write the stored results for v1 or v2 instead of processing inputs")
+    parser.add_argument("--since", help="with --export-stored: only submissions on or after YYYY-MM-DD")
+    parser.add_argument("--metrics-out", help="write run metrics here (.prom for Prometheus text, else JSON)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="debug logging")
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.export_stored:
+        parser.error("give CSV inputs or --export-stored VERSION")
+    if args.format == "parquet" and pipeline.pyarrow is None:
+        parser.error("--format parquet needs pyarrow (pip install pyarrow)")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+
+    secrets = pipeline.load_secrets(args.secrets)
+    cache_settings = secrets.setdefault("cache", {})
+    if args.no_cache:
+        cache_settings["enabled"] = False
+    if args.cache_path:
+        cache_settings["path"] = args.cache_path
+    # Every API worker across the parallel files needs its own pooled connection
+    processing_settings = secrets.setdefault("processing", {})
+    concurrency = args.concurrency or int(processing_settings.get("max_concurrency", pipeline.MAX_CONCURRENCY))
+    processing_settings["http_pool_size"] = max(
+        int(processing_settings.get("http_pool_size", 0)), concurrency * max(args.jobs, 1)
+    )
+    pipeline.configure(secrets)
+
+    paths = expand_inputs(args.inputs)
+    if not args.dry_run or args.export_stored:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    # The rate limiter and response cache are process-wide, so parallel files share one quota
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        outcomes = list(pool.map(lambda path: run_one(path, args), paths))
+    if args.export_stored:
+        outcomes.append(export_stored(args))
+
+    if args.metrics_out:
+        with open(args.metrics_out, "w", encoding="utf-8") as fh:
+            fh.write(metrics.to_prometheus() if args.metrics_out.endswith(".prom") else metrics.to_json())
+
+    return 0 if all(outcomes) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,495 +1,319 @@
 import streamlit as st
 import pandas as pd
 import io
-import re
-import pytz
-import firebase_admin
-from firebase_admin import credentials, firestore
-import openai
+import os
+import functools
+import tempfile
+import time
+import pipeline
+from metrics import Metrics, metrics, use_metrics
 
 ########################################
-# 1) OPENAI & FIREBASE SETUP
+# SETUP
 ########################################
 
-openai.api_key = st.secrets["openai"]["api_key"]
+# Streamlit re-executes this script on every interaction; the pipeline is
+# configured once per server process and its clients are reused across reruns.
+@st.cache_resource
+def init_pipeline():
+    pipeline.configure(st.secrets.to_dict())
+    return pipeline
 
-firebase_creds = st.secrets["firebase_service_account"].to_dict()
-if not firebase_admin._apps:
-    cred = credentials.Certificate(firebase_creds)
-    firebase_admin.initialize_app(cred)
+init_pipeline()
 
-db = firestore.client()
-
-########################################
-# 2) FIRESTORE HELPERS
-########################################
-
-def is_record_processed_version(record_id, version):
-    collection_name = f"processed_records_{version}"
-    doc_ref = db.collection(collection_name).document(record_id)
-
-    # DEBUG
-    print("Firestore path:", doc_ref.path)
-    # or, if you have a logger:
-    # logger.debug(f"Checking document: {doc_ref.path}")
-
-    
-    return doc_ref.get().exists
-
-def mark_record_as_processed_version(record_id, version):
-    collection_name = f"processed_records_{version}"
-    doc_ref = db.collection(collection_name).document(record_id)
-    doc_ref.set({"processed": True})
-
-########################################
-# 3) DETERMINE FILE VERSION
-########################################
-
-def determine_version(df):
-    """
-    Returns 'v2' if any column ends with '_v2',
-    returns 'v1' if any column ends with '_v1',
-    otherwise returns None.
-    """
-    if any(col.endswith("_v2") for col in df.columns):
-        return "v2"
-    elif any(col.endswith("_v1") for col in df.columns):
-        return "v1"
-    else:
-        return None
-
-########################################
-# 4) LINE BREAK INSERTION
 ########################################
-
-def insert_line_breaks(text):
-    """
-    Insert a newline after a period (.) followed by two or more spaces.
-    e.g., "Normal exam.  Abdomen: Soft..." -> "Normal exam.\nAbdomen: Soft..."
-    """
-    if not isinstance(text, str):
-        return text
-    return re.sub(r'\.\s{2,}', '.\n', text)
-
-########################################
-# 5) AGE MAPPING
-########################################
-
-age_mapping = {
-    1: "0 days", 2: "1 day", 3: "2 days", 4: "3 days", 5: "4 days", 6: "5 days",
-    7: "6 days", 8: "7 days", 9: "8 days", 10: "9 days", 11: "10 days", 12: "11 days",
-    13: "12 days", 14: "13 days", 15: "14 days", 16: "15 days", 17: "16 days",
-    18: "17 days", 19: "18 days", 20: "19 days", 21: "20 days", 22: "21 days",
-    23: "22 days", 24: "23 days", 25: "24 days", 26: "25 days", 27: "26 days",
-    28: "27 days", 29: "28 days", 30: "29 days", 31: "30 days", 32: "1 week",
-    33: "2 weeks", 34: "3 weeks", 35: "4 weeks", 36: "5 weeks", 37: "6 weeks",
-    38: "7 weeks", 39: "8 weeks", 40: "9 weeks", 41: "10 weeks", 42: "11 weeks",
-    43: "12 weeks", 44: "1 month", 45: "2 months", 46: "3 months", 47: "4 months",
-    48: "5 months", 49: "6 months", 50: "7 months", 51: "8 months", 52: "9 months",
-    53: "10 months", 54: "11 months", 55: "1 year", 56: "2 years", 57: "3 years",
-    58: "4 years", 59: "5 years", 60: "6 years", 61: "7 years", 62: "8 years",
-    63: "9 years", 64: "10 years", 65: "11 years", 66: "12 years", 67: "13 years",
-    68: "14 years", 69: "15 years", 70: "16 years", 71: "17 years", 72: "18 years",
-    73: "19 years", 74: "20 years", 75: "21 years", 76: "22 years", 77: "23 years",
-    78: "24 years", 79: "25 years", 80: "26 years", 81: "27 years", 82: "28 years",
-    83: "29 years", 84: "30 years"
-}
-
-########################################
-# 6) BUILDING ADDITIONAL COLUMNS (DYNAMIC)
+# STREAMLIT UI
 ########################################
 
-def build_additional_columns(df, version):
-    """
-    Dynamically build 'additional_hx_{version}' and 'vital_signs_and_growth_{version}'
-    if the relevant source columns exist, referencing pmhx_{version}, pshx_{version}, etc.
-    """
-    # 1) Build 'additional_hx_{version}' if pmhx_{version}, pshx_{version}, etc. exist
-    pmhx_col  = f"pmhx_{version}"
-    pshx_col  = f"pshx_{version}"
-    famhx_col = f"famhx_{version}"
-    diet_col  = f"diet_{version}"
-    birth_col = f"birthhx_{version}"
-    dev_col   = f"dev_{version}"
-    soc_col   = f"soc_hx_features_{version}"
-    med_col   = f"med_{version}"
-    all_col   = f"all_{version}"
-    imm_col   = f"imm_{version}"
-
-    add_col_name = f"additional_hx_{version}"
-    # Only build if the columns exist
-    if pmhx_col in df.columns:
-        df[add_col_name] = (
-            'Past Medical History: ' + df[pmhx_col].fillna('') + '\n' +
-            'Past Surgical History: ' + df.get(pshx_col, '').fillna('') + '\n' +
-            'Family History: ' + df.get(famhx_col, '').fillna('') + '\n' +
-            'Dietary History: ' + df.get(diet_col, '').fillna('') + '\n' +
-            'Birth History: ' + df.get(birth_col, '').fillna('') + '\n' +
-            'Developmental History: ' + df.get(dev_col, '').fillna('') + '\n' +
-            'Social History: ' + df.get(soc_col, '').fillna('') + '\n' +
-            'Medications: ' + df.get(med_col, '').fillna('') + '\n' +
-            'Allergies: ' + df.get(all_col, '').fillna('') + '\n' +
-            'Immunizations: ' + df.get(imm_col, '').fillna('') + '\n'
+# Download formats offered in the UI; Parquet only when pyarrow is installed
+FORMAT_LABELS = {"csv": "CSV", "xlsx": "Excel (XLSX)", "parquet": "Parquet"}
+if pipeline.pyarrow is None:
+    del FORMAT_LABELS["parquet"]
+
+def to_csv_buffer(df, version):
+    return pipeline.export_buffer(df, version, "csv")
+
+# Download buttons get a callable for the file contents: Streamlit only runs it
+# when the button is clicked, so reruns don't re-encode the export each time.
+
+def chunked_download(output_path, version, fmt):
+    """The chunked run's output as a download, re-encoding the on-disk CSV chunk by chunk."""
+    if fmt == "csv":
+        with open(output_path, "rb") as fh:
+            return fh.read()
+    buffer = io.BytesIO()
+    with open(output_path, "rb") as fh:
+        pipeline.convert_output(fh, version, buffer, fmt)
+    buffer.seek(0)
+    return buffer
+
+def download_label(what, fmt):
+    return f"Download {what} {FORMAT_LABELS[fmt]}"
+
+def render_metrics(run_metrics):
+    """Expandable per-stage timing / counter panel with JSON and Prometheus exports."""
+    with st.expander("Run metrics"):
+        stages = run_metrics["snapshot"]["stages"]
+        if stages:
+            st.table([{"stage": name, **stage} for name, stage in stages.items()])
+        st.json(run_metrics["snapshot"], expanded=False)
+        st.download_button(
+            label="Download metrics (JSON)",
+            data=run_metrics["json"],
+            file_name="docsub_metrics.json",
+            mime="application/json"
         )
-
-    # 2) Build 'vital_signs_and_growth_{version}' if temp_{version}, hr_{version}, etc. exist
-    temp_col   = f"temp_{version}"
-    hr_col     = f"hr_{version}"
-    rr_col     = f"rr_{version}"
-    pulseox_col= f"pulseox_{version}"
-    sbp_col    = f"sbp_{version}"
-    dbp_col    = f"dbp_{version}"
-    weight_col = f"weight_{version}"
-    weighttile_col = f"weighttile_{version}"
-    height_col = f"height_{version}"
-    heighttile_col = f"heighttile_{version}"
-    bmi_col    = f"bmi_{version}"
-    bmitile_col= f"bmitile_{version}"
-
-    vit_col_name = f"vital_signs_and_growth_{version}"
-    if temp_col in df.columns:
-        df[vit_col_name] = (
-            'Temperature: ' + df.get(temp_col, '').astype(str) + '\n' +
-            'Heart Rate: ' + df.get(hr_col, '').astype(str) + '\n' +
-            'Respiratory Rate: ' + df.get(rr_col, '').astype(str) + '\n' +
-            'Pulse Oximetry: ' + df.get(pulseox_col, '').astype(str) + '\n' +
-            'Systolic Blood Pressure: ' + df.get(sbp_col, '').astype(str) + '\n' +
-            'Diastolic Blood Pressure: ' + df.get(dbp_col, '').astype(str) + '\n' +
-            'Weight: ' + df.get(weight_col, '').astype(str) + ' (' + df.get(weighttile_col, '').fillna('') + ')\n' +
-            'Height: ' + df.get(height_col, '').astype(str) + ' (' + df.get(heighttile_col, '').fillna('') + ')\n' +
-            'BMI: ' + df.get(bmi_col, '').astype(str) + ' (' + df.get(bmitile_col, '').fillna('') + ')'
+        st.download_button(
+            label="Download metrics (Prometheus)",
+            data=run_metrics["prometheus"],
+            file_name="docsub_metrics.prom",
+            mime="text/plain"
         )
 
-########################################
-# 7) AI ANALYSIS (DYNAMIC)
-########################################
+def render_results(df_processed, version, run_metrics, fmt):
+    st.success("File processed successfully!")
+    response_cache = pipeline.get_response_cache()
+    if response_cache is not None:
+        stats = response_cache.stats()
+        st.caption(f"Response cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
+    st.dataframe(df_processed[pipeline.output_columns(df_processed, version)])
+
+    output_filename = f"processed_file_{version}.{fmt}"
+    st.download_button(
+        label=download_label("Processed", fmt),
+        data=functools.partial(pipeline.export_buffer, df_processed, version, fmt),
+        file_name=output_filename,
+        mime=pipeline.EXPORT_FORMATS[fmt]
+    )
+    render_metrics(run_metrics)
 
-def analyze_notes_2(row, version):
+def stream_upload(uploaded_file, mode):
     """
-    references columns: historyofpresentillness_{version}, agex_{version}, mostlikelydiagnosis_{version}
+    Runs the AI analysis with live progress, throughput, a growing table and a partial
+    download. Returns (df_processed, version, run_metrics), or None if there is nothing
+    to process.
     """
-    hpi_col  = f"historyofpresentillness_{version}"
-    agex_col = f"agex_{version}"
-    dx_col   = f"mostlikelydiagnosis_{version}"
-
-    statement = row.get(hpi_col, "")
-    age = row.get(agex_col, "")
-    dx  = row.get(dx_col, "")
-
-    prompt = (
-        f"Assume you are an experienced medical educator evaluating 3rd-year medical students' clinical documentation. "
-        f"Please review the following history of present illness for a pediatric patient (age: {age}) "
-        f"with the primary diagnosis of {dx}. "
-        f"Identify the top 3 essential pieces of information missing or inadequately addressed in the documentation. "
-        f"Provide brief constructive feedback on what should be included. "
-        f"The statement to review is:\n\"{statement}\"\n"
-    )
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=500
-    )
-    return response['choices'][0]['message']['content']
-
-def analyze_notes_4(row, version):
-    add_col   = f"additional_hx_{version}"
-    vit_col   = f"vital_signs_and_growth_{version}"
-    pe_col    = f"physicalexam_{version}"
-    ros_col   = f"reviewofsystems_{version}"
-    hpi_col   = f"historyofpresentillness_{version}"
-    agex_col  = f"agex_{version}"
-    dx_col    = f"mostlikelydiagnosis_{version}"
-
-    statement1 = row.get(add_col, "")
-    statement2 = row.get(vit_col, "")
-    statement3 = row.get(pe_col, "")
-    ros        = row.get(ros_col, "")
-    hpi        = row.get(hpi_col, "")
-    age        = row.get(agex_col, "")
-    dx         = row.get(dx_col, "")
-
-    prompt = (
-        f"Assume you are an experienced medical educator and a harsh grader of medical documentation. "
-        f"Please review the additional history of a pediatric patient (age: {age}), the HPI: {hpi}, "
-        f"ROS: {ros}, and physical exam (Physical Exam: {statement2} {statement3}), "
-        f"along with the primary diagnosis ({dx}). Identify the top 3 essential pieces of information missing "
-        f"or inadequately addressed. The statement to review is:\n\"{statement1}\"\n\n"
-        f"Do not ask for the HPI, primary diagnosis, or physical exam again as this information is already provided."
-    )
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=500
-    )
-    return response['choices'][0]['message']['content']
-
-def analyze_notes_9(row, version):
-    vit_col  = f"vital_signs_and_growth_{version}"
-    pe_col   = f"physicalexam_{version}"
-    hpi_col  = f"historyofpresentillness_{version}"
-    agex_col = f"agex_{version}"
-    dx_col   = f"mostlikelydiagnosis_{version}"
-
-    statement1 = row.get(vit_col, "")
-    statement2 = row.get(pe_col, "")
-    hpi        = row.get(hpi_col, "")
-    age        = row.get(agex_col, "")
-    dx         = row.get(dx_col, "")
-
-    prompt = (
-        f"Assume you are an experienced medical educator evaluating 3rd-year medical students' clinical documentation. "
-        f"Please review the physical examination of a pediatric patient (age: {age}) with the primary diagnosis of {dx} "
-        f"and the history of present illness (HPI): {hpi}. Identify the top 3 essential pieces of information missing or "
-        f"inadequately addressed in the physical exam. "
-        f"The statement to review is:\n\"{statement1} {statement2}\"\n"
-    )
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=500
-    )
-    return response['choices'][0]['message']['content']
-
-def analyze_notes_12(row, version):
-    add_col   = f"additional_hx_{version}"
-    vit_col   = f"vital_signs_and_growth_{version}"
-    pe_col    = f"physicalexam_{version}"
-    ros_col   = f"reviewofsystems_{version}"
-    hpi_col   = f"historyofpresentillness_{version}"
-    agex_col  = f"agex_{version}"
-    dxs_col   = f"dxs_{version}"
-    dx_col    = f"mostlikelydiagnosis_{version}"
-    dxj_col   = f"mostlikelydiagnosisj_{version}"
-    secdx_col = f"seclikelydiagnosis_{version}"
-    secjx_col = f"seclikelydiagnosisj_{version}"
-    thrdx_col = f"thirlikelydiagnosis_{version}"
-    thrjx_col = f"thirlikelydiagnosisj_{version}"
-
-    statement1 = row.get(add_col, "")
-    statement2 = row.get(vit_col, "")
-    statement3 = row.get(pe_col, "")
-    ros        = row.get(ros_col, "")
-    hpi        = row.get(hpi_col, "")
-    age        = row.get(agex_col, "")
-    dxs        = row.get(dxs_col, "")
-    dx         = row.get(dx_col, "")
-    dxj        = row.get(dxj_col, "")
-    secdx      = row.get(secdx_col, "")
-    secjx      = row.get(secjx_col, "")
-    thrdx      = row.get(thrdx_col, "")
-    thrjx      = row.get(thrjx_col, "")
-
-    prompt = (
-        f"Assume you are an experienced medical educator and a harsh grader of medical documentation. "
-        f"Please review the following information about a pediatric patient (age: {age}):\n\n"
-        f"1. HPI: {hpi}\n"
-        f"2. ROS: {ros}\n"
-        f"3. Physical Exam: {statement2} {statement3}\n"
-        f"4. Additional History: {statement1}\n"
-        f"5. Diagnostic Studies: {dxs}\n"
-        f"6. Primary Diagnosis: {dx} (Justification: {dxj})\n"
-        f"7. Secondary Diagnosis: {secdx} (Justification: {secjx})\n"
-        f"8. Tertiary Diagnosis: {thrdx} (Justification: {thrjx})\n\n"
-        f"Does the primary diagnosis have at least three supporting findings?\n"
-        f"Are the secondary and tertiary diagnoses appropriate?\n"
-        f"Do not ask for HPI, ROS, physical exam, or diagnoses again, as all details are provided."
-    )
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=500
-    )
-    return response['choices'][0]['message']['content']
-
-def analyze_notes_15(row, version):
-    add_col   = f"additional_hx_{version}"
-    vit_col   = f"vital_signs_and_growth_{version}"
-    pe_col    = f"physicalexam_{version}"
-    ros_col   = f"reviewofsystems_{version}"
-    hpi_col   = f"historyofpresentillness_{version}"
-    agex_col  = f"agex_{version}"
-    dxs_col   = f"dxs_{version}"
-    dx_col    = f"mostlikelydiagnosis_{version}"
-    dxj_col   = f"mostlikelydiagnosisj_{version}"
-    secdx_col = f"seclikelydiagnosis_{version}"
-    secjx_col = f"seclikelydiagnosisj_{version}"
-    thrdx_col = f"thirlikelydiagnosis_{version}"
-    thrjx_col = f"thirlikelydiagnosisj_{version}"
-
-    statement1 = row.get(add_col, "")
-    statement2 = row.get(vit_col, "")
-    statement3 = row.get(pe_col, "")
-    ros        = row.get(ros_col, "")
-    hpi        = row.get(hpi_col, "")
-    age        = row.get(agex_col, "")
-    dxs        = row.get(dxs_col, "")
-    dx         = row.get(dx_col, "")
-    dxj        = row.get(dxj_col, "")
-    secdx      = row.get(secdx_col, "")
-    secjx      = row.get(secjx_col, "")
-    thrdx      = row.get(thrdx_col, "")
-    thrjx      = row.get(thrjx_col, "")
-
-    prompt = (
-        f"Assume you are an experienced medical educator and a harsh grader of medical documentation. "
-        f"Please review the following info for a pediatric patient (age: {age}):\n\n"
-        f"1. HPI: {hpi}\n"
-        f"2. ROS: {ros}\n"
-        f"3. Physical Exam: {statement2} {statement3}\n"
-        f"4. Additional History: {statement1}\n"
-        f"5. Diagnostic Studies: {dxs}\n"
-        f"6. Primary Diagnosis: {dx} (Justification: {dxj})\n"
-        f"7. Secondary Diagnosis: {secdx} (Justification: {secjx})\n"
-        f"8. Tertiary Diagnosis: {thrdx} (Justification: {thrjx})\n\n"
-        f"Check for grammatical/spelling errors and clarity in the HPI and diagnosis justifications. "
-        f"Show me any problematic sentences and suggest revisions."
-    )
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=500
+    try:
+        prepared = pipeline.prepare_upload(uploaded_file.getvalue())
+    except pipeline.PipelineError as exc:
+        st.error(str(exc))
+        return None
+    if prepared is None:
+        st.info("All record_ids have already been processed.")
+        return None
+    df_prepared, version, journal, resumed, reuse = prepared
+    total = len(df_prepared)
+    if resumed:
+        st.info(f"Resuming from checkpoint: {resumed} record(s) already analyzed.")
+    if reuse:
+        st.info(f"{len(reuse)} resubmitted record(s): only the sections whose inputs changed are re-analyzed.")
+
+    projection = pipeline.estimate_run_cost(df_prepared, version, mode, reuse)
+    st.info(
+        f"Projected: {projection['requests']} API request(s), {projection['prompt_tokens']:,} prompt tokens, "
+        f"at most ${projection['max_cost_usd']:.2f}."
     )
-    return response['choices'][0]['message']['content']
+    if pipeline.over_budget(projection):
+        st.error(f"Projected cost exceeds the run budget of ${pipeline.RUN_BUDGET_USD:.2f}; not starting.")
+        return None
 
-########################################
-# 8) PROCESS FILE
-########################################
+    progress = st.progress(0.0, text=f"Running AI analysis for {version}...")
+    throughput_slot = st.empty()
+    table_slot = st.empty()
+    partial_download_slot = st.empty()
+
+    completed = {}
+    started = time.time()
+    last_render = 0.0
+    analysis = pipeline.iter_ai_analysis(df_prepared, version, journal=journal, mode=mode, reuse=reuse)
+    with metrics.stage("ai_analysis"):
+        for pos, results, errors in analysis:
+            completed[pos] = (results, errors)
+            done = len(completed)
+            progress.progress(done / total, text=f"Analyzed {done} of {total} record(s)")
+
+            # Re-render the table and partial download at most once a second
+            now = time.time()
+            if now - last_render >= 1.0 and done < total:
+                last_render = now
+                elapsed_min = (now - started) / 60
+                throughput_slot.caption(f"Throughput: {done / elapsed_min:.1f} rows/min")
+                df_partial = pipeline.apply_ai_results(df_prepared, version, completed)
+                table_slot.dataframe(df_partial)
+                partial_download_slot.download_button(
+                    label=f"Download Partial CSV ({done}/{total})",
+                    data=to_csv_buffer(df_partial, version),
+                    file_name=f"partial_processed_file_{version}.csv",
+                    mime="text/csv",
+                    key=f"partial_download_{done}",
+                    on_click="ignore"
+                )
+
+    df_processed = pipeline.apply_ai_results(df_prepared, version, completed)
+    failed = pipeline.finalize_upload(df_processed, version, journal)
+    if failed:
+        st.warning(f"{failed} record(s) had AI errors and were not marked processed.")
+
+    elapsed_min = max(time.time() - started, 1e-6) / 60
+    st.caption(f"Throughput: {total / elapsed_min:.1f} rows/min")
+    for slot in (progress, throughput_slot, table_slot, partial_download_slot):
+        slot.empty()
+
+    return df_processed, version, snapshot_metrics()
+
+def snapshot_metrics():
+    # Plain-data copy of the run's registry, kept with the result for later reruns
+    return {
+        "snapshot": metrics.snapshot(),
+        "json": metrics.to_json(),
+        "prometheus": metrics.to_prometheus(),
+    }
+
+# Rows shown on screen for a chunked run; the full output stays on disk
+CHUNKED_PREVIEW_ROWS = 200
 
-def process_file(uploaded_file):
+def stream_chunked_upload(uploaded_file, mode):
     """
-    Reads CSV as strings, determines version, filters out processed records,
-    inserts line breaks, builds dynamic columns, runs dynamic AI analysis,
-    marks records processed, returns (df, version).
+    Chunked ingestion for large exports: analyzes one chunk at a time and appends it
+    to a CSV on disk. Returns (output_path, version, run_metrics), or None if there
+    is nothing to process.
     """
-    # 1) Read all as strings to preserve "1" as "1"
-    #df = pd.read_csv(uploaded_file, dtype=str)
-    df = pd.read_csv(uploaded_file, dtype=str, keep_default_na=False,na_filter=False)
-
-    # 2) Determine version
-    version = determine_version(df)
-    if version is None:
-        st.error("No version indicator (_v1 or _v2) found in columns.")
+    try:
+        prepared = pipeline.prepare_chunked_upload(uploaded_file)
+    except pipeline.PipelineError as exc:
+        st.error(str(exc))
         return None
-
-    # 3) Remove existing record_id if any
-    if "record_id" in df.columns:
-        df.drop(columns=["record_id"], inplace=True)
-
-    # Identify email column
-    email_col = next((col for col in df.columns if "email" in col.lower()), None)
-    if not email_col:
-        st.error("No email column found.")
+    if prepared is None:
+        st.info("All record_ids have already been processed.")
         return None
+    version = prepared.version
 
-    hpi_col = f"historyofpresentillness_{version}"
-    hpiwords_col = f"hpiwords_{version}"
-    
-    # Check if the history of present illness column exists
-    if hpi_col in df.columns:
-        df[hpiwords_col] = df[hpi_col].apply(lambda x: len(x.split()) if isinstance(x, str) else 0)
-    else:
-        st.error(f"Expected column '{hpi_col}' not found.")
+    with st.spinner("Projecting the run's cost..."):
+        projection = pipeline.estimate_chunked_cost(prepared, mode)
+    st.info(
+        f"Projected: {projection['requests']} API request(s), {projection['prompt_tokens']:,} prompt tokens, "
+        f"at most ${projection['max_cost_usd']:.2f}."
+    )
+    if pipeline.over_budget(projection):
+        st.error(f"Projected cost exceeds the run budget of ${pipeline.RUN_BUDGET_USD:.2f}; not starting.")
         return None
 
-    df["record_id"] = df[email_col].astype(str)
-
-    # Filter out processed
-    df = df[~df["record_id"].apply(lambda rid: is_record_processed_version(rid, version))]
-    if df.empty:
+    with tempfile.NamedTemporaryFile(prefix="docsub_", suffix=f"_{version}.csv", delete=False) as fh:
+        output_path = fh.name
+
+    progress = st.progress(0.0, text=f"Running chunked AI analysis for {version}...")
+    started = time.time()
+    written = failed = 0
+    try:
+        for done, total, written, failed in pipeline.iter_chunked_upload(prepared, output_path, mode=mode):
+            elapsed_min = max(time.time() - started, 1e-6) / 60
+            progress.progress(
+                done / total,
+                text=f"Analyzed {done} of {total} record(s), {done / elapsed_min:.1f} rows/min"
+            )
+    except BaseException:
+        # Includes the rerun/stop exceptions Streamlit raises to interrupt the script
+        remove_output(output_path)
+        raise
+    progress.empty()
+    if not written:
+        remove_output(output_path)
         st.info("All record_ids have already been processed.")
         return None
-
-    # Move record_id to the front
-    df = df[["record_id"] + [c for c in df.columns if c != "record_id"]]
-
-    # Timestamps
-    timestamp_mapping = {
-        "documentation_submission_1_timestamp": "peddoclate1",
-        "documentation_submission_2_timestamp": "peddoclate2"
-    }
-    timestamp_col = None
-    for original_col, new_col in timestamp_mapping.items():
-        if original_col in df.columns:
-            df.rename(columns={original_col: new_col}, inplace=True)
-            timestamp_col = new_col
-            df[new_col] = pd.to_datetime(df[new_col], errors="coerce")
-            df[new_col] = df[new_col].dt.tz_localize("UTC").dt.tz_convert("US/Eastern")
-            df[new_col] = df[new_col].dt.strftime("%m-%d-%Y %H:%M")
-
-    df.drop(columns=[email_col], inplace=True)
-
-    if timestamp_col:
-        df["timestamp_sort"] = pd.to_datetime(df[timestamp_col], format="%m-%d-%Y %H:%M", errors="coerce")
-        df = df.sort_values(by="timestamp_sort", ascending=False).drop_duplicates(subset=["record_id"], keep="first")
-        df.drop(columns=["timestamp_sort"], inplace=True)
-
-    # 4) Convert age_{version} to numeric, then map to agex_{version}
-    age_col = f"age_{version}"
-    if age_col in df.columns:
-        df[age_col] = pd.to_numeric(df[age_col], errors="coerce").astype('Int64') 
-        df[f"agex_{version}"] = df[age_col].map(age_mapping)
-
-    # 5) Insert line breaks in certain text columns (like physicalexam_{version}, etc.)
-    text_cols_to_fix = [
-        f"physicalexam_{version}",
-        f"vital_signs_and_growth_{version}",
-        f"historyofpresentillness_{version}"
-        # add more if needed
-    ]
-    for col in text_cols_to_fix:
-        if col in df.columns:
-            df[col] = df[col].apply(insert_line_breaks)
-
-
-
-    # 6) Build additional columns (like additional_hx_{version}, vital_signs_and_growth_{version})
-    build_additional_columns(df, version)
-
-    # 7) Run dynamic AI analysis
-    st.info(f"Running AI analysis for {version}... (this may take a while)")
-    df[f"notes_2_{version}"]  = df.apply(lambda row: analyze_notes_2(row, version), axis=1)
-    df[f"notes_4_{version}"]  = df.apply(lambda row: analyze_notes_4(row, version), axis=1)
-    df[f"notes_9_{version}"]  = df.apply(lambda row: analyze_notes_9(row, version), axis=1)
-    df[f"notes_12_{version}"] = df.apply(lambda row: analyze_notes_12(row, version), axis=1)
-    df[f"notes_15_{version}"] = df.apply(lambda row: analyze_notes_15(row, version), axis=1)
-
-    # 8) Mark processed
-    for rid in df["record_id"]:
-        mark_record_as_processed_version(rid, version)
-
-    return df, version
-
-########################################
-# 9) STREAMLIT UI
-########################################
+    if failed:
+        st.warning(f"{failed} record(s) had AI errors and were not marked processed.")
+
+    return output_path, version, snapshot_metrics()
+
+def remove_output(output_path):
+    try:
+        os.remove(output_path)
+    except FileNotFoundError:
+        pass
+
+def discard_result():
+    """Drops the stored result, deleting a chunked run's output file with it."""
+    cached = st.session_state.pop("processed_result", None)
+    if cached is not None and cached[1]:
+        remove_output(cached[2][0])
+
+def render_chunked_results(output_path, version, run_metrics, fmt):
+    st.success("File processed successfully!")
+    st.caption(f"Showing the first {CHUNKED_PREVIEW_ROWS} rows; the download has all of them.")
+    st.dataframe(pd.read_csv(output_path, dtype=str, keep_default_na=False, nrows=CHUNKED_PREVIEW_ROWS))
+
+    st.download_button(
+        label=download_label("Processed", fmt),
+        data=functools.partial(chunked_download, output_path, version, fmt),
+        file_name=f"processed_file_{version}.{fmt}",
+        mime=pipeline.EXPORT_FORMATS[fmt]
+    )
+    render_metrics(run_metrics)
 
 st.title("CSV Processor (Dynamic) with AI & Version-Specific Firestore")
 
+combined_mode = st.checkbox(
+    "Combined prompt mode (one call per student, per-section fallback)",
+    value=pipeline.ANALYSIS_MODE == "combined"
+)
+mode = "combined" if combined_mode else "separate"
+chunked_mode = st.checkbox(
+    "Chunked mode for large exports (bounded memory, results written to disk)",
+    value=False
+)
+export_format = st.selectbox(
+    "Download format", list(FORMAT_LABELS), format_func=FORMAT_LABELS.get
+)
 uploaded_file = st.file_uploader("Upload a CSV file", type=["csv"])
 if uploaded_file:
-    result = process_file(uploaded_file)
+    # Reruns (e.g. clicking download or ticking a checkbox) reuse the stored result
+    # for the same file instead of re-running dedup queries and analysis; the mode
+    # checkboxes apply to the next upload.
+    result_key = pipeline.source_hash(uploaded_file)
+    cached = st.session_state.get("processed_result")
+    if cached is not None and cached[0] == result_key:
+        _, result_chunked, result = cached
+    else:
+        discard_result()
+        result_chunked = chunked_mode
+        # Each run records into its own registry, so concurrent sessions don't mix counts
+        with use_metrics(Metrics()):
+            if chunked_mode:
+                result = stream_chunked_upload(uploaded_file, mode)
+            else:
+                result = stream_upload(uploaded_file, mode)
     if result is not None:
-        df_processed, version = result
-        st.success("File processed successfully!")
-        st.dataframe(df_processed)
-
-        # Drop columns like additional_hx_{version}, vital_signs_and_growth_{version}, agex_{version}
-        columns_to_remove = [
-            f"additional_hx_{version}",
-            f"vital_signs_and_growth_{version}",
-            f"agex_{version}"
-        ]
-        for col in columns_to_remove:
-            if col in df_processed.columns:
-                df_processed.drop(columns=[col], inplace=True)
-
-        output_filename = f"processed_file_{version}.csv"
-        buffer = io.BytesIO()
-        df_processed.to_csv(buffer, index=False)
-        buffer.seek(0)
-        st.download_button(
-            label="Download Processed CSV",
-            data=buffer,
-            file_name=output_filename,
-            mime="text/csv"
+        st.session_state["processed_result"] = (result_key, result_chunked, result)
+
+    if result is not None and result_chunked:
+        render_chunked_results(*result, export_format)
+    elif result is not None:
+        df_processed, version, run_metrics = result
+        render_results(df_processed, version, run_metrics, export_format)
+else:
+    discard_result()
+
+# Exports rebuilt from the results store: a Firestore read, no AI calls
+with st.expander("Export stored results"):
+    export_version = st.selectbox("Version", ["v1", "v2"], index=1)
+    submitted_since = st.date_input("Submitted on or after (optional)", value=None)
+    if st.button("Load stored results"):
+        since = pd.Timestamp(submitted_since, tz="US/Eastern").to_pydatetime() if submitted_since else None
+        st.session_state["stored_results"] = (
+            export_version, pipeline.load_results(export_version, submitted_since=since)
         )
+
+    stored = st.session_state.get("stored_results")
+    if stored is not None:
+        stored_version, df_stored = stored
+        if df_stored.empty:
+            st.info(f"No stored {stored_version} results match.")
+        else:
+            st.caption(f"{len(df_stored)} stored {stored_version} record(s)")
+            st.dataframe(df_stored)
+            st.download_button(
+                label=download_label("Stored Results", export_format),
+                data=functools.partial(pipeline.export_buffer, df_stored, stored_version, export_format),
+                file_name=f"stored_results_{stored_version}.{export_format}",
+                mime=pipeline.EXPORT_FORMATS[export_format]
+            )
@@ -0,0 +1,151 @@
+"""
+Lightweight in-process instrumentation for the pipeline: per-stage timings,
+labelled counters and latency histograms, exportable as JSON or Prometheus text.
+"""
+import contextvars
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) for latency histogram buckets
+LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, math.inf)
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+class Metrics:
+    """Thread-safe registry of stage timings, counters and histograms."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}      # stage -> [seconds, calls]
+            self._counters = {}    # (name, labels) -> value
+            self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block and adds it to the named stage."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                entry = self._stages.setdefault(name, [0.0, 0])
+                entry[0] += elapsed
+                entry[1] += 1
+
+    def incr(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            entry = self._histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        """Plain-dict view of everything recorded so far."""
+        with self._lock:
+            return {
+                "stages": {
+                    name: {"seconds": round(seconds, 4), "calls": calls}
+                    for name, (seconds, calls) in self._stages.items()
+                },
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": count,
+                        "sum": round(total, 4),
+                        "buckets": {str(bound): n for bound, n in zip(self.buckets, counts)},
+                    }
+                    for (name, labels), (counts, total, count) in sorted(self._histograms.items())
+                ],
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix="docsub"):
+        """Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            if self._stages:
+                lines.append(f"# TYPE {prefix}_stage_seconds_total counter")
+                for name, (seconds, _) in sorted(self._stages.items()):
+                    lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} {seconds:.6f}')
+                lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+                for name, (_, calls) in sorted(self._stages.items()):
+                    lines.append(f'{prefix}_stage_calls_total{{stage="{name}"}} {calls}')
+
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = f"{prefix}_{name}_total"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric}{_format_labels(labels)} {value}")
+
+            for (name, labels), (counts, total, count) in sorted(self._histograms.items()):
+                metric = f"{prefix}_{name}"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} histogram")
+                for bound, n in zip(self.buckets, counts):
+                    le = "+Inf" if bound == math.inf else f"{bound:g}"
+                    lines.append(f"{metric}_bucket{_format_labels(labels, [('le', le)])} {n}")
+                lines.append(f"{metric}_sum{_format_labels(labels)} {total:.6f}")
+                lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+# Registry activated by use_metrics() for the current context, if any
+_active = contextvars.ContextVar("metrics", default=None)
+_process_metrics = Metrics()
+
+class _CurrentMetrics:
+    """
+    Stands in for the registry pipeline.py records into: the one use_metrics()
+    activated for the current run, else the process-wide one.
+    """
+
+    def __getattr__(self, name):
+        return getattr(_active.get() or _process_metrics, name)
+
+@contextmanager
+def use_metrics(registry):
+    """
+    Sends `metrics` calls made in this context to registry, so concurrent runs
+    (e.g. Streamlit sessions) keep separate counts. Worker threads join it by
+    running in a copy of the caller's context (contextvars.copy_context()).
+    """
+    token = _active.set(registry)
+    try:
+        yield registry
+    finally:
+        _active.reset(token)
+
+metrics = _CurrentMetrics()
@@ -0,0 +1,2012 @@
+"""
+Documentation-feedback pipeline: CSV ingestion, Firestore dedup, prompt
+building, concurrent OpenAI analysis and processed-record bookkeeping.
+Used by the Streamlit app (docsub.py) and the command-line runner (cli.py);
+call configure() with a secrets mapping before processing.
+"""
+import pandas as pd
+import io
+import os
+import json
+import logging
+import tomllib
+import re
+import pytz
+import hashlib
+import time
+import random
+import sqlite3
+import threading
+import string
+import contextlib
+import contextvars
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import firebase_admin
+from firebase_admin import credentials, firestore
+import openai
+import requests
+import xlsxwriter
+
+from metrics import metrics
+
+try:
+    import tiktoken
+except ImportError:  # fall back to a character-based estimate
+    tiktoken = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet exports are unavailable without it
+    pyarrow = None
+
+########################################
+# 1) SETTINGS, OPENAI & FIREBASE SETUP
+########################################
+
+logger = logging.getLogger("docsub")
+
+class PipelineError(Exception):
+    """An upload that can't be processed (missing version, email or HPI column, ...)."""
+
+# Concurrency / retry settings for the AI analysis (overridable via [processing] in secrets)
+MAX_CONCURRENCY = 8
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 2.0
+REQUEST_TIMEOUT = 60.0
+
+# Default model and completion budget; [routing.<section>] in secrets can send a
+# section (notes_2, ..., notes_15, combined) to another model, max_tokens or backend
+OPENAI_MODEL = "gpt-3.5-turbo"
+MAX_TOKENS = 500
+
+# Keep-alive connections shared by the API worker threads (defaults to MAX_CONCURRENCY)
+HTTP_POOL_SIZE = 0
+
+# "separate" sends one prompt per notes section; "combined" sends the shared
+# context once per row and asks for all five sections as JSON
+ANALYSIS_MODE = "separate"
+COMBINED_MAX_TOKENS = 2500
+
+# Local response cache settings (overridable via [cache] in secrets)
+CACHE_ENABLED = True
+CACHE_PATH = os.path.join(".docsub_cache", "responses.sqlite3")
+CACHE_MAX_ENTRIES = 20000
+CACHE_MAX_AGE_DAYS = 30.0
+
+# Per-upload checkpoint journals, keyed by the uploaded file's hash; journals
+# untouched for JOURNAL_MAX_AGE_DAYS (abandoned uploads) are deleted
+JOURNAL_DIR = os.path.join(".docsub_cache", "journals")
+JOURNAL_MAX_AGE_DAYS = 7.0
+
+# Token budgeting and rate limits (overridable via [limits] in secrets); 0 disables a limit
+REQUESTS_PER_MINUTE = 3500
+TOKENS_PER_MINUTE = 160000
+MAX_FIELD_TOKENS = 1500
+MAX_PROMPT_TOKENS = 12000
+PROMPT_PRICE_PER_1K = 0.0005
+COMPLETION_PRICE_PER_1K = 0.0015
+RUN_BUDGET_USD = 0.0
+
+_firebase_creds = None
+_db = None
+_http_session = None
+_client_lock = threading.Lock()
+
+def load_secrets(path=os.path.join(".streamlit", "secrets.toml")):
+    """
+    Reads the same secrets.toml the Streamlit app uses. OPENAI_API_KEY in the
+    environment overrides [openai] api_key.
+    """
+    secrets = {}
+    if os.path.exists(path):
+        with open(path, "rb") as fh:
+            secrets = tomllib.load(fh)
+    if os.environ.get("OPENAI_API_KEY"):
+        secrets.setdefault("openai", {})["api_key"] = os.environ["OPENAI_API_KEY"]
+    return secrets
+
+def configure(secrets):
+    """
+    Applies a secrets mapping (the layout of .streamlit/secrets.toml) to the module
+    settings and clients: [openai], [firebase_service_account], [processing],
+    [cache], [limits], [backends.<name>] and [routing.<section>].
+    Settings a mapping doesn't mention keep their current value.
+    """
+    global MAX_CONCURRENCY, MAX_RETRIES, RETRY_BASE_DELAY, REQUEST_TIMEOUT, HTTP_POOL_SIZE
+    global OPENAI_MODEL, MAX_TOKENS, ANALYSIS_MODE, COMBINED_MAX_TOKENS
+    global CACHE_ENABLED, CACHE_PATH, CACHE_MAX_ENTRIES, CACHE_MAX_AGE_DAYS, JOURNAL_DIR
+    global JOURNAL_MAX_AGE_DAYS
+    global REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE, MAX_FIELD_TOKENS, MAX_PROMPT_TOKENS
+    global PROMPT_PRICE_PER_1K, COMPLETION_PRICE_PER_1K, RUN_BUDGET_USD
+    global _firebase_creds, _db, _http_session, _response_cache, _rate_limiter
+
+    processing_settings = secrets.get("processing", {})
+    MAX_CONCURRENCY = int(processing_settings.get("max_concurrency", MAX_CONCURRENCY))
+    MAX_RETRIES = int(processing_settings.get("max_retries", MAX_RETRIES))
+    RETRY_BASE_DELAY = float(processing_settings.get("retry_base_delay", RETRY_BASE_DELAY))
+    REQUEST_TIMEOUT = float(processing_settings.get("request_timeout", REQUEST_TIMEOUT))
+    HTTP_POOL_SIZE = int(processing_settings.get("http_pool_size", HTTP_POOL_SIZE))
+    ANALYSIS_MODE = processing_settings.get("analysis_mode", ANALYSIS_MODE)
+    COMBINED_MAX_TOKENS = int(processing_settings.get("combined_max_tokens", COMBINED_MAX_TOKENS))
+
+    cache_settings = secrets.get("cache", {})
+    CACHE_ENABLED = bool(cache_settings.get("enabled", CACHE_ENABLED))
+    CACHE_PATH = cache_settings.get("path", CACHE_PATH)
+    CACHE_MAX_ENTRIES = int(cache_settings.get("max_entries", CACHE_MAX_ENTRIES))
+    CACHE_MAX_AGE_DAYS = float(cache_settings.get("max_age_days", CACHE_MAX_AGE_DAYS))
+    JOURNAL_DIR = cache_settings.get("journal_dir", JOURNAL_DIR)
+    JOURNAL_MAX_AGE_DAYS = float(cache_settings.get("journal_max_age_days", JOURNAL_MAX_AGE_DAYS))
+
+    limit_settings = secrets.get("limits", {})
+    REQUESTS_PER_MINUTE = int(limit_settings.get("requests_per_minute", REQUESTS_PER_MINUTE))
+    TOKENS_PER_MINUTE = int(limit_settings.get("tokens_per_minute", TOKENS_PER_MINUTE))
+    MAX_FIELD_TOKENS = int(limit_settings.get("max_field_tokens", MAX_FIELD_TOKENS))
+    MAX_PROMPT_TOKENS = int(limit_settings.get("max_prompt_tokens", MAX_PROMPT_TOKENS))
+    PROMPT_PRICE_PER_1K = float(limit_settings.get("prompt_price_per_1k", PROMPT_PRICE_PER_1K))
+    COMPLETION_PRICE_PER_1K = float(limit_settings.get("completion_price_per_1k", COMPLETION_PRICE_PER_1K))
+    RUN_BUDGET_USD = float(limit_settings.get("run_budget_usd", RUN_BUDGET_USD))
+
+    if "openai" in secrets:
+        openai_settings = secrets["openai"]
+        if "api_key" in openai_settings:
+            openai.api_key = openai_settings["api_key"]
+        OPENAI_MODEL = openai_settings.get("model", OPENAI_MODEL)
+        MAX_TOKENS = int(openai_settings.get("max_tokens", MAX_TOKENS))
+    for name, backend_settings in secrets.get("backends", {}).items():
+        register_backend(ChatBackend(name, **backend_settings))
+    for section, route_settings in secrets.get("routing", {}).items():
+        _routes[section] = dict(route_settings)
+    if "firebase_service_account" in secrets:
+        _firebase_creds = dict(secrets["firebase_service_account"])
+        _db = None
+
+    # Rebuilt lazily with the new settings
+    _http_session = None
+    _response_cache = None
+    _rate_limiter = None
+
+def set_db(client):
+    """Uses a pre-built Firestore client (an emulator client or a local stand-in) instead of Firebase."""
+    global _db
+    with _client_lock:
+        _db = client
+
+def get_db():
+    """The Firestore client, initializing the Firebase app on first use."""
+    global _db
+    with _client_lock:
+        if _db is None:
+            if not firebase_admin._apps:
+                if _firebase_creds is None:
+                    raise PipelineError("Firebase credentials are not configured.")
+                cred = credentials.Certificate(_firebase_creds)
+                firebase_admin.initialize_app(cred)
+            _db = firestore.client()
+        return _db
+
+class _SharedSession(requests.Session):
+    """
+    A Session that outlives close(). The openai client closes each thread's
+    session after MAX_SESSION_LIFETIME_SECS and opens a new one; with a shared
+    session that would tear down the pool under every other worker.
+    """
+
+    def close(self):
+        pass
+
+def get_http_session():
+    """
+    The requests.Session every backend call goes through, installed as
+    openai.requestssession so the worker threads share one keep-alive
+    connection pool instead of opening a session each.
+    """
+    global _http_session
+    with _client_lock:
+        if _http_session is None:
+            pool_size = HTTP_POOL_SIZE or MAX_CONCURRENCY
+            # max_retries matches the adapter the openai client mounts on its own sessions
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=2)
+            _http_session = _SharedSession()
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+            openai.requestssession = _http_session
+        return _http_session
+
+class ChatBackend:
+    """
+    An OpenAI-compatible chat completions endpoint. With no api_base it is the
+    OpenAI API; with one it is any server speaking the same protocol (vLLM,
+    llama.cpp, Ollama, ...). Local servers are usually not rate_limited by our
+    OpenAI quota. Subclass and override complete() to plug in another client.
+    """
+
+    def __init__(self, name, api_base=None, api_key=None, rate_limited=True):
+        self.name = name
+        self.api_base = api_base
+        # The openai client refuses to send a request without some key
+        self.api_key = api_key or ("unused" if api_base else None)
+        self.rate_limited = bool(rate_limited)
+
+    def complete(self, prompt, model, max_tokens):
+        """Returns an OpenAI-style response: choices[0].message.content plus usage."""
+        get_http_session()
+        endpoint = {}
+        if self.api_base:
+            endpoint["api_base"] = self.api_base
+        if self.api_key:
+            endpoint["api_key"] = self.api_key
+        return openai.ChatCompletion.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens,
+            request_timeout=REQUEST_TIMEOUT,
+            **endpoint
+        )
+
+# Backends by name; routes refer to them by name
+_backends = {"openai": ChatBackend("openai")}
+
+# Raw [routing.<section>] settings; "default" applies to every section
+_routes = {}
+
+# Where a section's prompts go: backend name, model and completion budget
+Route = namedtuple("Route", ["backend", "model", "max_tokens"])
+
+def register_backend(backend):
+    """Adds a backend, replacing any registered under the same name."""
+    with _client_lock:
+        _backends[backend.name] = backend
+
+def get_backend(name):
+    with _client_lock:
+        backend = _backends.get(name)
+    if backend is None:
+        raise PipelineError(f"Unknown LLM backend '{name}'.")
+    return backend
+
+def get_route(section):
+    """The Route for a section: [routing.<section>] over [routing.default] over the global defaults."""
+    settings = {**_routes.get("default", {}), **_routes.get(section, {})}
+    max_tokens = COMBINED_MAX_TOKENS if section == "combined" else MAX_TOKENS
+    return Route(
+        settings.get("backend", "openai"),
+        settings.get("model", OPENAI_MODEL),
+        int(settings.get("max_tokens", max_tokens)),
+    )
+
+########################################
+# 2) FIRESTORE HELPERS
+########################################
+
+# Max document references sent per db.get_all() call
+DEDUP_CHUNK_SIZE = 100
+
+def get_processed_fingerprints(record_ids, version):
+    """
+    Returns {record_id: {section: input fingerprint}} for the record_ids already
+    marked processed for this version ({} when the record was marked without
+    fingerprints). Records are fetched in chunks via db.get_all(), reading only
+    the fingerprints field, so the lookup costs one round trip per
+    DEDUP_CHUNK_SIZE records.
+    """
+    db = get_db()
+    collection = db.collection(f"processed_records_{version}")
+    record_ids = list(dict.fromkeys(record_ids))
+    processed = {}
+
+    for start in range(0, len(record_ids), DEDUP_CHUNK_SIZE):
+        refs = [collection.document(rid) for rid in record_ids[start:start + DEDUP_CHUNK_SIZE]]
+        metrics.incr("firestore_round_trips", op="get_all")
+        for snapshot in db.get_all(refs, field_paths=["fingerprints"]):
+            if snapshot.exists:
+                processed[snapshot.id] = (snapshot.to_dict() or {}).get("fingerprints") or {}
+
+    return processed
+
+def get_processed_record_ids(record_ids, version):
+    """Returns the subset of record_ids already marked processed for this version."""
+    return set(get_processed_fingerprints(record_ids, version))
+
+def is_record_processed_version(record_id, version):
+    return record_id in get_processed_record_ids([record_id], version)
+
+# Firestore caps a WriteBatch at 500 operations
+FIRESTORE_BATCH_SIZE = 500
+
+def write_documents(collection_name, documents):
+    """
+    Sets documents ({doc_id: data}) in a collection using WriteBatch commits of
+    up to FIRESTORE_BATCH_SIZE writes, committed concurrently. Each batch is atomic.
+    """
+    db = get_db()
+    collection = db.collection(collection_name)
+    doc_ids = list(documents)
+    chunks = [doc_ids[i:i + FIRESTORE_BATCH_SIZE] for i in range(0, len(doc_ids), FIRESTORE_BATCH_SIZE)]
+
+    def commit_chunk(chunk):
+        batch = db.batch()
+        for doc_id in chunk:
+            batch.set(collection.document(doc_id), documents[doc_id])
+        batch.commit()
+        metrics.incr("firestore_round_trips", op="batch_commit")
+
+    if chunks:
+        with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY, len(chunks))) as pool:
+            # Run in copies of the caller's context so metrics reach the run's registry
+            futures = [pool.submit(contextvars.copy_context().run, commit_chunk, chunk) for chunk in chunks]
+            for future in futures:
+                future.result()
+
+def mark_records_as_processed_version(record_ids, version, metadata=None):
+    """
+    Marks many records processed in concurrent WriteBatch commits (write_documents).
+    metadata maps record_id -> extra fields (models, prompt hashes, fingerprints, ...)
+    stored alongside the processed flag, version and server timestamp.
+    """
+    metadata = metadata or {}
+    record_ids = list(dict.fromkeys(record_ids))
+    documents = {}
+    for rid in record_ids:
+        data = {
+            "processed": True,
+            "processed_at": firestore.SERVER_TIMESTAMP,
+            "version": version,
+        }
+        data.update(metadata.get(rid, {}))
+        documents[rid] = data
+    write_documents(f"processed_records_{version}", documents)
+
+def mark_record_as_processed_version(record_id, version):
+    mark_records_as_processed_version([record_id], version)
+
+# Processed rows are kept in results_{version}, one document per record with the
+# exported row, its column order, the submission time and the processing time, so
+# exports can be rebuilt from the store without any LLM calls.
+
+def store_results(df, version):
+    """
+    Writes each row's export columns (as the strings a CSV export would hold) to
+    results_{version}/{record_id}, replacing the record's previous result.
+    submitted_at comes from the hidden submitted_at_{version} column, which keeps
+    the parsed timezone-aware time that the display string can't round-trip
+    across a DST fall-back.
+    """
+    if df.empty:
+        return
+    columns = output_columns(df, version)
+    submitted_at = df.get(f"submitted_at_{version}", pd.Series(pd.NaT, index=df.index))
+
+    rows = df[columns].astype("string").fillna("").to_dict("records")
+    documents = {}
+    for row, when in zip(rows, submitted_at):
+        documents[row["record_id"]] = {
+            "record_id": row["record_id"],
+            "version": version,
+            "submitted_at": None if pd.isna(when) else when.to_pydatetime(),
+            "processed_at": firestore.SERVER_TIMESTAMP,
+            "columns": columns,
+            "row": row,
+        }
+    write_documents(f"results_{version}", documents)
+
+def get_stored_sections(record_ids, version):
+    """
+    Returns {record_id: {notes key: text}} from the records' stored results, for
+    reusing the sections a resubmission didn't change. Records without a stored
+    result are left out, so their sections are analyzed again.
+    """
+    db = get_db()
+    collection = db.collection(f"results_{version}")
+    record_ids = list(dict.fromkeys(record_ids))
+    sections = {}
+    for start in range(0, len(record_ids), DEDUP_CHUNK_SIZE):
+        refs = [collection.document(rid) for rid in record_ids[start:start + DEDUP_CHUNK_SIZE]]
+        metrics.incr("firestore_round_trips", op="get_all")
+        for snapshot in db.get_all(refs, field_paths=["row"]):
+            if snapshot.exists:
+                row = (snapshot.to_dict() or {}).get("row") or {}
+                sections[snapshot.id] = {
+                    key: row[f"{key}_{version}"] for key in ANALYSIS_FUNCS if f"{key}_{version}" in row
+                }
+    return sections
+
+def load_results(version, record_ids=None, submitted_since=None):
+    """
+    Reads stored results for a version back into an export-ready DataFrame, latest
+    submission first. record_ids limits it to those records (one get_all round trip
+    per DEDUP_CHUNK_SIZE); submitted_since (a timezone-aware datetime) to submissions
+    at or after it.
+    Returns an empty DataFrame when nothing matches.
+    """
+    db = get_db()
+    collection = db.collection(f"results_{version}")
+    if record_ids is not None:
+        record_ids = list(dict.fromkeys(record_ids))
+        snapshots = []
+        for start in range(0, len(record_ids), DEDUP_CHUNK_SIZE):
+            refs = [collection.document(rid) for rid in record_ids[start:start + DEDUP_CHUNK_SIZE]]
+            metrics.incr("firestore_round_trips", op="get_all")
+            snapshots.extend(snapshot for snapshot in db.get_all(refs) if snapshot.exists)
+    else:
+        query = collection
+        if submitted_since is not None:
+            query = query.where(filter=firestore.FieldFilter("submitted_at", ">=", submitted_since))
+        metrics.incr("firestore_round_trips", op="stream")
+        snapshots = list(query.stream())
+
+    docs = [snapshot.to_dict() for snapshot in snapshots]
+    if record_ids is not None and submitted_since is not None:
+        docs = [doc for doc in docs if doc.get("submitted_at") and doc["submitted_at"] >= submitted_since]
+    if not docs:
+        return pd.DataFrame()
+
+    # Latest submission first, like a fresh export; records without a time go last
+    docs.sort(key=lambda doc: (doc.get("submitted_at") is not None, doc.get("submitted_at") or 0), reverse=True)
+
+    columns = list(dict.fromkeys(col for doc in docs for col in doc.get("columns", [])))
+    return pd.DataFrame([doc.get("row", {}) for doc in docs], columns=columns).fillna("")
+
+########################################
+# 3) DETERMINE FILE VERSION
+########################################
+
+def determine_version(df):
+    """
+    Returns 'v2' if any column ends with '_v2',
+    returns 'v1' if any column ends with '_v1',
+    otherwise returns None.
+    """
+    if any(col.endswith("_v2") for col in df.columns):
+        return "v2"
+    elif any(col.endswith("_v1") for col in df.columns):
+        return "v1"
+    else:
+        return None
+
+########################################
+# 4) LINE BREAK INSERTION
+########################################
+
+# A period followed by two or more spaces marks a sentence/section break in the exports
+LINE_BREAK_PATTERN = r'\.\s{2,}'
+
+def insert_line_breaks(text):
+    """
+    Insert a newline after a period (.) followed by two or more spaces.
+    e.g., "Normal exam.  Abdomen: Soft..." -> "Normal exam.\nAbdomen: Soft..."
+    """
+    if not isinstance(text, str):
+        return text
+    return re.sub(LINE_BREAK_PATTERN, '.\n', text)
+
+def insert_line_breaks_column(series):
+    """Vectorized insert_line_breaks for a whole column."""
+    return series.str.replace(LINE_BREAK_PATTERN, '.\n', regex=True)
+
+def word_count_column(series):
+    r"""
+    Whitespace-delimited word counts for a column (0 for non-strings).
+    A single pass of str.split() over the values: on long free text it beats
+    both .str.count(r"\S+") and .str.split().str.len(), which build more
+    intermediate objects per row.
+    """
+    return pd.Series(
+        [len(text.split()) if isinstance(text, str) else 0 for text in series.tolist()],
+        index=series.index,
+        dtype=int,
+    )
+
+########################################
+# 5) AGE MAPPING
+########################################
+
+age_mapping = {
+    1: "0 days", 2: "1 day", 3: "2 days", 4: "3 days", 5: "4 days", 6: "5 days",
+    7: "6 days", 8: "7 days", 9: "8 days", 10: "9 days", 11: "10 days", 12: "11 days",
+    13: "12 days", 14: "13 days", 15: "14 days", 16: "15 days", 17: "16 days",
+    18: "17 days", 19: "18 days", 20: "19 days", 21: "20 days", 22: "21 days",
+    23: "22 days", 24: "23 days", 25: "24 days", 26: "25 days", 27: "26 days",
+    28: "27 days", 29: "28 days", 30: "29 days", 31: "30 days", 32: "1 week",
+    33: "2 weeks", 34: "3 weeks", 35: "4 weeks", 36: "5 weeks", 37: "6 weeks",
+    38: "7 weeks", 39: "8 weeks", 40: "9 weeks", 41: "10 weeks", 42: "11 weeks",
+    43: "12 weeks", 44: "1 month", 45: "2 months", 46: "3 months", 47: "4 months",
+    48: "5 months", 49: "6 months", 50: "7 months", 51: "8 months", 52: "9 months",
+    53: "10 months", 54: "11 months", 55: "1 year", 56: "2 years", 57: "3 years",
+    58: "4 years", 59: "5 years", 60: "6 years", 61: "7 years", 62: "8 years",
+    63: "9 years", 64: "10 years", 65: "11 years", 66: "12 years", 67: "13 years",
+    68: "14 years", 69: "15 years", 70: "16 years", 71: "17 years", 72: "18 years",
+    73: "19 years", 74: "20 years", 75: "21 years", 76: "22 years", 77: "23 years",
+    78: "24 years", 79: "25 years", 80: "26 years", 81: "27 years", 82: "28 years",
+    83: "29 years", 84: "30 years"
+}
+
+########################################
+# 6) BUILDING ADDITIONAL COLUMNS (DYNAMIC)
+########################################
+
+# Templates for the combined prompt-context columns; each {field} is filled from
+# the "{field}_{version}" column, or left blank when the export doesn't have it
+ADDITIONAL_HX_TEMPLATE = (
+    "Past Medical History: {pmhx}\n"
+    "Past Surgical History: {pshx}\n"
+    "Family History: {famhx}\n"
+    "Dietary History: {diet}\n"
+    "Birth History: {birthhx}\n"
+    "Developmental History: {dev}\n"
+    "Social History: {soc_hx_features}\n"
+    "Medications: {med}\n"
+    "Allergies: {all}\n"
+    "Immunizations: {imm}\n"
+)
+VITAL_SIGNS_TEMPLATE = (
+    "Temperature: {temp}\n"
+    "Heart Rate: {hr}\n"
+    "Respiratory Rate: {rr}\n"
+    "Pulse Oximetry: {pulseox}\n"
+    "Systolic Blood Pressure: {sbp}\n"
+    "Diastolic Blood Pressure: {dbp}\n"
+    "Weight: {weight} ({weighttile})\n"
+    "Height: {height} ({heighttile})\n"
+    "BMI: {bmi} ({bmitile})"
+)
+
+def text_column(df, col):
+    """df[col] as strings with blanks for missing values; all blanks if the column is absent."""
+    if col not in df.columns:
+        return [""] * len(df)
+    return df[col].fillna("").astype(str).tolist()
+
+def fill_template(df, template, version):
+    """
+    Renders template once per row in a single pass. The named fields are resolved
+    to "{field}_{version}" columns up front and the template is compiled to a
+    positional format string, so no intermediate Series are built per field.
+    """
+    literals, fields = [], []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        literals.append(literal.replace("{", "{{").replace("}", "}}"))
+        if field is not None:
+            literals.append(f"{{{len(fields)}}}")
+            fields.append(field)
+    positional = "".join(literals)
+    columns = [text_column(df, f"{field}_{version}") for field in fields]
+    return pd.Series([positional.format(*values) for values in zip(*columns)], index=df.index, dtype=object)
+
+def build_additional_columns(df, version):
+    """
+    Dynamically build 'additional_hx_{version}' and 'vital_signs_and_growth_{version}'
+    if the relevant source columns exist, referencing pmhx_{version}, pshx_{version}, etc.
+    Other source columns missing from the export are rendered blank.
+    """
+    # 1) Build 'additional_hx_{version}' if pmhx_{version} exists
+    if f"pmhx_{version}" in df.columns:
+        df[f"additional_hx_{version}"] = fill_template(df, ADDITIONAL_HX_TEMPLATE, version)
+
+    # 2) Build 'vital_signs_and_growth_{version}' if temp_{version} exists
+    if f"temp_{version}" in df.columns:
+        df[f"vital_signs_and_growth_{version}"] = fill_template(df, VITAL_SIGNS_TEMPLATE, version)
+
+########################################
+# 7) RESPONSE CACHE
+########################################
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of completion text keyed on prompt_hash().
+    Entries older than max_age_days are dropped, and the least recently used
+    entries are evicted once the cache grows past max_entries.
+    """
+
+    def __init__(self, path, max_entries=None, max_age_days=None, read_only=False):
+        self.max_entries = CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.max_age_seconds = (CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days) * 86400
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        if read_only:
+            # For contains() lookups only: no schema setup, eviction or writes
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.evict()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def contains(self, key):
+        """Like get() but without touching counters or recency; used for cost projection."""
+        with self._lock:
+            row = self._conn.execute("SELECT created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        return row is not None and time.time() - row[0] <= self.max_age_seconds
+
+    def put(self, key, response):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            self._conn.commit()
+            self._puts += 1
+        if self._puts % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        """Drops expired entries, then the least recently used ones beyond max_entries."""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+_response_cache = None
+
+def get_response_cache(read_only=False):
+    """
+    The process-wide ResponseCache, or None when caching is disabled. read_only
+    callers that only look entries up get a read-only view of the cache file
+    while it isn't open yet (None if there is no file), so they never create or
+    trim it.
+    """
+    global _response_cache
+    with _client_lock:
+        if _response_cache is None and CACHE_ENABLED:
+            if read_only:
+                return ResponseCache(CACHE_PATH, read_only=True) if os.path.exists(CACHE_PATH) else None
+            _response_cache = ResponseCache(CACHE_PATH)
+        return _response_cache
+
+########################################
+# 8) CHECKPOINT JOURNAL
+########################################
+
+class RowJournal:
+    """
+    Append-only JSON-lines checkpoint of finished rows for one uploaded file.
+    Each line is {"record_id": ..., "results": {notes_key: text}} and is flushed
+    to disk as soon as the row completes, so a crash only loses rows in flight.
+    Nothing touches the disk until the first append, so a dry run leaves no trace.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # record_ids on disk: read on first use, then kept current by append/forget
+        self._ids = None
+        self._opened = False
+
+    def _entries(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from a crash mid-write; the row simply reruns
+                    continue
+                yield entry["record_id"], entry["results"]
+
+    def completed_ids(self):
+        """The record_ids with a journaled row."""
+        if self._ids is None:
+            self._ids = {rid for rid, _ in self._entries()}
+        return self._ids
+
+    def completed(self, record_ids=None):
+        """
+        Returns record_id -> results for the journaled rows, limited to record_ids
+        when given. The file is only read when one of them is journaled, so a
+        chunk with nothing to resume costs no I/O.
+        """
+        if record_ids is not None:
+            wanted = self.completed_ids() & set(record_ids)
+            if not wanted:
+                return {}
+        else:
+            wanted = None
+        return {rid: results for rid, results in self._entries() if wanted is None or rid in wanted}
+
+    def append(self, record_id, results):
+        if not self._opened:
+            # First write of a run: make the directory and clear out abandoned journals
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            expire_journals()
+            self._opened = True
+        with open(self.path, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps({"record_id": record_id, "results": results}) + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+        if self._ids is not None:
+            self._ids.add(record_id)
+
+    def forget(self, record_ids):
+        """
+        Drops the entries for record_ids once their rows are marked processed,
+        rewriting the file without them, or deleting it when nothing is left.
+        """
+        forgotten = self.completed_ids() & set(record_ids)
+        if not forgotten:
+            return
+        remaining = self._ids - forgotten
+        if remaining:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as fh:
+                for rid, results in self._entries():
+                    if rid in remaining:
+                        fh.write(json.dumps({"record_id": rid, "results": results}) + "\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, self.path)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+        self._ids = remaining
+
+def upload_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def source_hash(source, block_size=1 << 20):
+    """upload_hash of a path or seekable file-like object, read in blocks instead of all at once."""
+    digest = hashlib.sha256()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as fh:
+            for block in iter(lambda: fh.read(block_size), b""):
+                digest.update(block)
+    else:
+        source.seek(0)
+        for block in iter(lambda: source.read(block_size), b""):
+            digest.update(block)
+        source.seek(0)
+    return digest.hexdigest()
+
+def expire_journals(max_age_days=None):
+    """Deletes journals not written to for max_age_days (default: JOURNAL_MAX_AGE_DAYS)."""
+    if not os.path.isdir(JOURNAL_DIR):
+        return
+    max_age_seconds = (JOURNAL_MAX_AGE_DAYS if max_age_days is None else max_age_days) * 86400
+    cutoff = time.time() - max_age_seconds
+    for name in os.listdir(JOURNAL_DIR):
+        path = os.path.join(JOURNAL_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                metrics.incr("journals_expired")
+        except FileNotFoundError:
+            # Removed concurrently by another run
+            continue
+
+def open_journal(digest):
+    """Returns the RowJournal for an upload's sha256."""
+    return RowJournal(os.path.join(JOURNAL_DIR, f"{digest}.jsonl"))
+
+def journal_for_upload(data):
+    """Returns the RowJournal for an upload, keyed by the sha256 of its bytes."""
+    return open_journal(upload_hash(data))
+
+########################################
+# 9) TOKEN BUDGET & RATE LIMITS
+########################################
+
+class PromptTooLargeError(ValueError):
+    """Raised instead of sending a prompt that exceeds MAX_PROMPT_TOKENS."""
+
+_encoding = None
+_encoding_loaded = False
+
+def _get_encoding():
+    """The model's tiktoken encoding, or None if tiktoken or its encoding files are unavailable."""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        # Other threads wait for the load instead of counting with the estimate
+        # meanwhile, which would truncate the same row's prompts differently
+        with _client_lock:
+            if not _encoding_loaded:
+                if tiktoken is not None:
+                    try:
+                        try:
+                            _encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+                        except KeyError:
+                            _encoding = tiktoken.get_encoding("cl100k_base")
+                    except Exception:
+                        # tiktoken downloads encodings on first use; stay on the estimate when offline
+                        _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+def count_tokens(text):
+    """Prompt token count from the local tokenizer, or ~4 characters per token without tiktoken."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Cuts text to max_tokens and appends a visible marker so both the model and
+    the grader can see the field was shortened. Shorter text is returned unchanged.
+    """
+    total = count_tokens(text)
+    if total <= max_tokens:
+        return text
+    encoding = _get_encoding()
+    if encoding is None:
+        kept = text[:max_tokens * 4]
+    else:
+        kept = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    return f"{kept} [TRUNCATED: field shortened from {total} to {max_tokens} tokens]"
+
+def prompt_field(row, col):
+    """row.get(col, "") with oversized free-text fields truncated to MAX_FIELD_TOKENS."""
+    value = row.get(col, "")
+    if MAX_FIELD_TOKENS and isinstance(value, str):
+        return truncate_to_tokens(value, MAX_FIELD_TOKENS)
+    return value
+
+class RateLimiter:
+    """
+    Shared sliding-window limiter for requests and tokens per minute.
+    acquire() blocks the calling worker until the request fits under both ceilings.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._events = deque()  # (monotonic time, tokens)
+        self._window_tokens = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        # A single request larger than the whole budget is let through on an empty window
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._events and now - self._events[0][0] >= 60:
+                    self._window_tokens -= self._events.popleft()[1]
+                fits_requests = not self.requests_per_minute or len(self._events) < self.requests_per_minute
+                fits_tokens = not self.tokens_per_minute or self._window_tokens + tokens <= self.tokens_per_minute
+                if fits_requests and fits_tokens:
+                    self._events.append((now, tokens))
+                    self._window_tokens += tokens
+                    return
+                wait_for = 60 - (now - self._events[0][0])
+            time.sleep(min(max(wait_for, 0.05), 1.0))
+
+_rate_limiter = None
+
+def get_rate_limiter():
+    """The process-wide RateLimiter, shared by every session and file since they all draw on one API quota."""
+    global _rate_limiter
+    with _client_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+        return _rate_limiter
+
+########################################
+# 10) AI ANALYSIS (DYNAMIC)
+########################################
+
+def prompt_hash(prompt, model=None, backend="openai"):
+    """
+    Stable fingerprint of a filled prompt for a backend and model (default:
+    OPENAI_MODEL on OpenAI). Keys for the OpenAI backend leave the name out so
+    existing cache entries stay valid.
+    """
+    target = model or OPENAI_MODEL
+    if backend != "openai":
+        target = f"{backend}/{target}"
+    return hashlib.sha256(f"{target}\n{prompt}".encode("utf-8")).hexdigest()
+
+def run_completion(prompt, section="unknown"):
+    """
+    Sends a single-prompt chat completion to the section's routed backend and model
+    and returns the reply text. Identical prompts for the same backend and model are
+    served from the response cache without an API call; calls to rate-limited
+    backends wait for their prompt + max_tokens budget. section (notes_2, ...,
+    combined) picks the route and labels the call's metrics.
+    """
+    route = get_route(section)
+    backend = get_backend(route.backend)
+    key = prompt_hash(prompt, route.model, route.backend)
+    response_cache = get_response_cache()
+    if response_cache is not None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            metrics.incr("cache_hits", section=section)
+            return cached
+        metrics.incr("cache_misses", section=section)
+
+    prompt_tokens = count_tokens(prompt)
+    if MAX_PROMPT_TOKENS and prompt_tokens > MAX_PROMPT_TOKENS:
+        metrics.incr("prompts_rejected", section=section)
+        raise PromptTooLargeError(f"prompt is {prompt_tokens} tokens (limit {MAX_PROMPT_TOKENS})")
+    if backend.rate_limited:
+        waited = time.perf_counter()
+        get_rate_limiter().acquire(prompt_tokens + route.max_tokens)
+        metrics.observe("rate_limit_wait_seconds", time.perf_counter() - waited)
+
+    started = time.perf_counter()
+    metrics.incr("api_calls", section=section, model=route.model)
+    try:
+        response = backend.complete(prompt, route.model, route.max_tokens)
+    except Exception as exc:
+        metrics.incr("api_errors", section=section, error=type(exc).__name__)
+        raise
+    finally:
+        metrics.observe("api_latency_seconds", time.perf_counter() - started, section=section)
+
+    usage = response.get("usage") or {}
+    metrics.incr("prompt_tokens", usage.get("prompt_tokens", prompt_tokens), section=section)
+    metrics.incr("completion_tokens", usage.get("completion_tokens", 0), section=section)
+
+    content = response['choices'][0]['message']['content']
+    if response_cache is not None:
+        response_cache.put(key, content)
+    return content
+
+def build_notes_2_prompt(row, version):
+    """
+    references columns: historyofpresentillness_{version}, agex_{version}, mostlikelydiagnosis_{version}
+    """
+    hpi_col  = f"historyofpresentillness_{version}"
+    agex_col = f"agex_{version}"
+    dx_col   = f"mostlikelydiagnosis_{version}"
+
+    statement = prompt_field(row, hpi_col)
+    age = prompt_field(row, agex_col)
+    dx  = prompt_field(row, dx_col)
+
+    prompt = (
+        f"Assume you are an experienced medical educator evaluating 3rd-year medical students' clinical documentation. "
+        f"Please review the following history of present illness for a pediatric patient (age: {age}) "
+        f"with the primary diagnosis of {dx}. "
+        f"Identify the top 3 essential pieces of information missing or inadequately addressed in the documentation. "
+        f"Provide brief constructive feedback on what should be included. "
+        f"The statement to review is:\n\"{statement}\"\n"
+    )
+    return prompt
+
+def build_notes_4_prompt(row, version):
+    add_col   = f"additional_hx_{version}"
+    vit_col   = f"vital_signs_and_growth_{version}"
+    pe_col    = f"physicalexam_{version}"
+    ros_col   = f"reviewofsystems_{version}"
+    hpi_col   = f"historyofpresentillness_{version}"
+    agex_col  = f"agex_{version}"
+    dx_col    = f"mostlikelydiagnosis_{version}"
+
+    statement1 = prompt_field(row, add_col)
+    statement2 = prompt_field(row, vit_col)
+    statement3 = prompt_field(row, pe_col)
+    ros        = prompt_field(row, ros_col)
+    hpi        = prompt_field(row, hpi_col)
+    age        = prompt_field(row, agex_col)
+    dx         = prompt_field(row, dx_col)
+
+    prompt = (
+        f"Assume you are an experienced medical educator and a harsh grader of medical documentation. "
+        f"Please review the additional history of a pediatric patient (age: {age}), the HPI: {hpi}, "
+        f"ROS: {ros}, and physical exam (Physical Exam: {statement2} {statement3}), "
+        f"along with the primary diagnosis ({dx}). Identify the top 3 essential pieces of information missing "
+        f"or inadequately addressed. The statement to review is:\n\"{statement1}\"\n\n"
+        f"Do not ask for the HPI, primary diagnosis, or physical exam again as this information is already provided."
+    )
+    return prompt
+
+def build_notes_9_prompt(row, version):
+    vit_col  = f"vital_signs_and_growth_{version}"
+    pe_col   = f"physicalexam_{version}"
+    hpi_col  = f"historyofpresentillness_{version}"
+    agex_col = f"agex_{version}"
+    dx_col   = f"mostlikelydiagnosis_{version}"
+
+    statement1 = prompt_field(row, vit_col)
+    statement2 = prompt_field(row, pe_col)
+    hpi        = prompt_field(row, hpi_col)
+    age        = prompt_field(row, agex_col)
+    dx         = prompt_field(row, dx_col)
+
+    prompt = (
+        f"Assume you are an experienced medical educator evaluating 3rd-year medical students' clinical documentation. "
+        f"Please review the physical examination of a pediatric patient (age: {age}) with the primary diagnosis of {dx} "
+        f"and the history of present illness (HPI): {hpi}. Identify the top 3 essential pieces of information missing or "
+        f"inadequately addressed in the physical exam. "
+        f"The statement to review is:\n\"{statement1} {statement2}\"\n"
+    )
+    return prompt
+
+def build_notes_12_prompt(row, version):
+    add_col   = f"additional_hx_{version}"
+    vit_col   = f"vital_signs_and_growth_{version}"
+    pe_col    = f"physicalexam_{version}"
+    ros_col   = f"reviewofsystems_{version}"
+    hpi_col   = f"historyofpresentillness_{version}"
+    agex_col  = f"agex_{version}"
+    dxs_col   = f"dxs_{version}"
+    dx_col    = f"mostlikelydiagnosis_{version}"
+    dxj_col   = f"mostlikelydiagnosisj_{version}"
+    secdx_col = f"seclikelydiagnosis_{version}"
+    secjx_col = f"seclikelydiagnosisj_{version}"
+    thrdx_col = f"thirlikelydiagnosis_{version}"
+    thrjx_col = f"thirlikelydiagnosisj_{version}"
+
+    statement1 = prompt_field(row, add_col)
+    statement2 = prompt_field(row, vit_col)
+    statement3 = prompt_field(row, pe_col)
+    ros        = prompt_field(row, ros_col)
+    hpi        = prompt_field(row, hpi_col)
+    age        = prompt_field(row, agex_col)
+    dxs        = prompt_field(row, dxs_col)
+    dx         = prompt_field(row, dx_col)
+    dxj        = prompt_field(row, dxj_col)
+    secdx      = prompt_field(row, secdx_col)
+    secjx      = prompt_field(row, secjx_col)
+    thrdx      = prompt_field(row, thrdx_col)
+    thrjx      = prompt_field(row, thrjx_col)
+
+    prompt = (
+        f"Assume you are an experienced medical educator and a harsh grader of medical documentation. "
+        f"Please review the following information about a pediatric patient (age: {age}):\n\n"
+        f"1. HPI: {hpi}\n"
+        f"2. ROS: {ros}\n"
+        f"3. Physical Exam: {statement2} {statement3}\n"
+        f"4. Additional History: {statement1}\n"
+        f"5. Diagnostic Studies: {dxs}\n"
+        f"6. Primary Diagnosis: {dx} (Justification: {dxj})\n"
+        f"7. Secondary Diagnosis: {secdx} (Justification: {secjx})\n"
+        f"8. Tertiary Diagnosis: {thrdx} (Justification: {thrjx})\n\n"
+        f"Does the primary diagnosis have at least three supporting findings?\n"
+        f"Are the secondary and tertiary diagnoses appropriate?\n"
+        f"Do not ask for HPI, ROS, physical exam, or diagnoses again, as all details are provided."
+    )
+    return prompt
+
+def build_notes_15_prompt(row, version):
+    add_col   = f"additional_hx_{version}"
+    vit_col   = f"vital_signs_and_growth_{version}"
+    pe_col    = f"physicalexam_{version}"
+    ros_col   = f"reviewofsystems_{version}"
+    hpi_col   = f"historyofpresentillness_{version}"
+    agex_col  = f"agex_{version}"
+    dxs_col   = f"dxs_{version}"
+    dx_col    = f"mostlikelydiagnosis_{version}"
+    dxj_col   = f"mostlikelydiagnosisj_{version}"
+    secdx_col = f"seclikelydiagnosis_{version}"
+    secjx_col = f"seclikelydiagnosisj_{version}"
+    thrdx_col = f"thirlikelydiagnosis_{version}"
+    thrjx_col = f"thirlikelydiagnosisj_{version}"
+
+    statement1 = prompt_field(row, add_col)
+    statement2 = prompt_field(row, vit_col)
+    statement3 = prompt_field(row, pe_col)
+    ros        = prompt_field(row, ros_col)
+    hpi        = prompt_field(row, hpi_col)
+    age        = prompt_field(row, agex_col)
+    dxs        = prompt_field(row, dxs_col)
+    dx         = prompt_field(row, dx_col)
+    dxj        = prompt_field(row, dxj_col)
+    secdx      = prompt_field(row, secdx_col)
+    secjx      = prompt_field(row, secjx_col)
+    thrdx      = prompt_field(row, thrdx_col)
+    thrjx      = prompt_field(row, thrjx_col)
+
+    prompt = (
+        f"Assume you are an experienced medical educator and a harsh grader of medical documentation. "
+        f"Please review the following info for a pediatric patient (age: {age}):\n\n"
+        f"1. HPI: {hpi}\n"
+        f"2. ROS: {ros}\n"
+        f"3. Physical Exam: {statement2} {statement3}\n"
+        f"4. Additional History: {statement1}\n"
+        f"5. Diagnostic Studies: {dxs}\n"
+        f"6. Primary Diagnosis: {dx} (Justification: {dxj})\n"
+        f"7. Secondary Diagnosis: {secdx} (Justification: {secjx})\n"
+        f"8. Tertiary Diagnosis: {thrdx} (Justification: {thrjx})\n\n"
+        f"Check for grammatical/spelling errors and clarity in the HPI and diagnosis justifications. "
+        f"Show me any problematic sentences and suggest revisions."
+    )
+    return prompt
+
+# Sections answered by build_combined_prompt
+COMBINED_SECTIONS = ("notes_2", "notes_4", "notes_9", "notes_12", "notes_15")
+
+def build_combined_prompt(row, version):
+    """
+    One prompt carrying the shared patient context once, asking for all five
+    feedback sections as a JSON object keyed notes_2, notes_4, notes_9, notes_12, notes_15.
+    """
+    statement1 = prompt_field(row, f"additional_hx_{version}")
+    statement2 = prompt_field(row, f"vital_signs_and_growth_{version}")
+    statement3 = prompt_field(row, f"physicalexam_{version}")
+    ros        = prompt_field(row, f"reviewofsystems_{version}")
+    hpi        = prompt_field(row, f"historyofpresentillness_{version}")
+    age        = prompt_field(row, f"agex_{version}")
+    dxs        = prompt_field(row, f"dxs_{version}")
+    dx         = prompt_field(row, f"mostlikelydiagnosis_{version}")
+    dxj        = prompt_field(row, f"mostlikelydiagnosisj_{version}")
+    secdx      = prompt_field(row, f"seclikelydiagnosis_{version}")
+    secjx      = prompt_field(row, f"seclikelydiagnosisj_{version}")
+    thrdx      = prompt_field(row, f"thirlikelydiagnosis_{version}")
+    thrjx      = prompt_field(row, f"thirlikelydiagnosisj_{version}")
+
+    prompt = (
+        f"Assume you are an experienced medical educator and a harsh grader of 3rd-year medical students' "
+        f"clinical documentation. Please review the following info for a pediatric patient (age: {age}):\n\n"
+        f"1. HPI: {hpi}\n"
+        f"2. ROS: {ros}\n"
+        f"3. Physical Exam: {statement2} {statement3}\n"
+        f"4. Additional History: {statement1}\n"
+        f"5. Diagnostic Studies: {dxs}\n"
+        f"6. Primary Diagnosis: {dx} (Justification: {dxj})\n"
+        f"7. Secondary Diagnosis: {secdx} (Justification: {secjx})\n"
+        f"8. Tertiary Diagnosis: {thrdx} (Justification: {thrjx})\n\n"
+        f"Write five separate feedback sections. All details above are provided, so do not ask for them again.\n"
+        f"- notes_2: Identify the top 3 essential pieces of information missing or inadequately addressed "
+        f"in the HPI, with brief constructive feedback on what should be included.\n"
+        f"- notes_4: Identify the top 3 essential pieces of information missing or inadequately addressed "
+        f"in the additional history.\n"
+        f"- notes_9: Identify the top 3 essential pieces of information missing or inadequately addressed "
+        f"in the physical exam.\n"
+        f"- notes_12: Does the primary diagnosis have at least three supporting findings? "
+        f"Are the secondary and tertiary diagnoses appropriate?\n"
+        f"- notes_15: Check for grammatical/spelling errors and clarity in the HPI and diagnosis justifications. "
+        f"Show any problematic sentences and suggest revisions.\n\n"
+        f"Respond with only a JSON object with exactly the keys "
+        f"\"notes_2\", \"notes_4\", \"notes_9\", \"notes_12\" and \"notes_15\", each a plain-text string."
+    )
+    return prompt
+
+def parse_combined_response(text):
+    """
+    Extracts the notes sections from a combined-mode reply. Returns only the
+    sections present as non-empty strings; a reply that isn't a JSON object gives {}.
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        return {}
+    try:
+        parsed = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    return {
+        key: value.strip()
+        for key, value in parsed.items()
+        if key in COMBINED_SECTIONS and isinstance(value, str) and value.strip()
+    }
+
+def analyze_notes_combined(row, version):
+    """Returns {notes_key: text} for every section that parsed from one combined call."""
+    return parse_combined_response(
+        run_completion(build_combined_prompt(row, version), section="combined")
+    )
+
+def analyze_notes_2(row, version):
+    return run_completion(build_notes_2_prompt(row, version), section="notes_2")
+
+def analyze_notes_4(row, version):
+    return run_completion(build_notes_4_prompt(row, version), section="notes_4")
+
+def analyze_notes_9(row, version):
+    return run_completion(build_notes_9_prompt(row, version), section="notes_9")
+
+def analyze_notes_12(row, version):
+    return run_completion(build_notes_12_prompt(row, version), section="notes_12")
+
+def analyze_notes_15(row, version):
+    return run_completion(build_notes_15_prompt(row, version), section="notes_15")
+
+########################################
+# 11) CONCURRENT AI ENGINE
+########################################
+
+# Each notes column and the prompt builder / analysis function that fill it, in output order
+PROMPT_BUILDERS = {
+    "notes_2": build_notes_2_prompt,
+    "notes_4": build_notes_4_prompt,
+    "notes_9": build_notes_9_prompt,
+    "notes_12": build_notes_12_prompt,
+    "notes_15": build_notes_15_prompt,
+}
+ANALYSIS_FUNCS = {
+    "notes_2": analyze_notes_2,
+    "notes_4": analyze_notes_4,
+    "notes_9": analyze_notes_9,
+    "notes_12": analyze_notes_12,
+    "notes_15": analyze_notes_15,
+}
+
+# Prepared columns (without the _{version} suffix) each notes prompt reads. A
+# resubmitted record only re-runs the sections whose inputs changed, e.g. an HPI
+# edit touches all five but a dietary history edit (in additional_hx) only 4/12/15.
+_DIAGNOSES = (
+    "dxs", "mostlikelydiagnosis", "mostlikelydiagnosisj", "seclikelydiagnosis",
+    "seclikelydiagnosisj", "thirlikelydiagnosis", "thirlikelydiagnosisj",
+)
+SECTION_INPUTS = {
+    "notes_2": ("historyofpresentillness", "agex", "mostlikelydiagnosis"),
+    "notes_4": (
+        "additional_hx", "vital_signs_and_growth", "physicalexam", "reviewofsystems",
+        "historyofpresentillness", "agex", "mostlikelydiagnosis",
+    ),
+    "notes_9": ("vital_signs_and_growth", "physicalexam", "historyofpresentillness", "agex", "mostlikelydiagnosis"),
+    "notes_12": (
+        "additional_hx", "vital_signs_and_growth", "physicalexam", "reviewofsystems",
+        "historyofpresentillness", "agex",
+    ) + _DIAGNOSES,
+    "notes_15": (
+        "additional_hx", "vital_signs_and_growth", "physicalexam", "reviewofsystems",
+        "historyofpresentillness", "agex",
+    ) + _DIAGNOSES,
+}
+
+def input_fingerprints(row, version):
+    """{notes key: sha256 of the prepared input fields its prompt reads} for one row."""
+    fingerprints = {}
+    for key, inputs in SECTION_INPUTS.items():
+        values = "\x1f".join(str(row.get(f"{name}_{version}", "")) for name in inputs)
+        fingerprints[key] = hashlib.sha256(values.encode("utf-8")).hexdigest()
+    return fingerprints
+
+# Transient OpenAI errors worth retrying
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+def call_with_retries(func, *args):
+    """
+    Calls func(*args), retrying rate-limit/timeout errors with exponential
+    backoff plus jitter. Re-raises the last error once MAX_RETRIES is exhausted.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return func(*args)
+        except RETRYABLE_ERRORS as exc:
+            if attempt == MAX_RETRIES:
+                raise
+            metrics.incr("api_retries", error=type(exc).__name__)
+            delay = RETRY_BASE_DELAY * (2 ** attempt)
+            time.sleep(delay + random.uniform(0, delay / 2))
+
+def iter_ai_analysis(df, version, max_workers=None, journal=None, mode=None, reuse=None):
+    """
+    Sends every row's jobs to a thread pool at once, bounded by max_workers, and
+    yields (pos, results, errors) for each row as soon as all of its jobs finish.
+    pos is the row's position in df, results maps notes key -> text and errors lists
+    the failed calls. In "separate" mode each row gets one job per notes type; in
+    "combined" mode it gets one combined job, and any section missing from the
+    parsed reply is queued as its own per-section job.
+    With a journal, rows it already holds are yielded first without API calls and
+    each newly finished, error-free row is appended to it. reuse maps record_id ->
+    {notes key: text} for sections kept from an earlier submission; only the
+    other sections of those rows are sent (separately, even in combined mode).
+    """
+    max_workers = max_workers or MAX_CONCURRENCY
+    mode = mode or ANALYSIS_MODE
+    reuse = reuse or {}
+    rows = [row for _, row in df.iterrows()]
+    saved = journal.completed(df["record_id"]) if journal is not None else {}
+
+    remaining = {}
+    restored = {}
+    for pos, row in enumerate(rows):
+        restored[pos] = {**reuse.get(row["record_id"], {}), **saved.get(row["record_id"], {})}
+        if all(key in restored[pos] for key in ANALYSIS_FUNCS):
+            metrics.incr("rows_restored_from_journal")
+            yield pos, {key: restored[pos][key] for key in ANALYSIS_FUNCS}, []
+        else:
+            remaining[pos] = 0
+
+    results = {pos: {key: restored[pos].get(key, "") for key in ANALYSIS_FUNCS} for pos in remaining}
+    errors = {pos: [] for pos in remaining}
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+
+    def submit(pos, key):
+        func = analyze_notes_combined if key == "combined" else ANALYSIS_FUNCS[key]
+        # A copy of the caller's context, so the call's metrics reach the run's registry
+        job = pool.submit(contextvars.copy_context().run, call_with_retries, func, rows[pos], version)
+        pending[job] = (pos, key)
+        remaining[pos] += 1
+
+    try:
+        for pos in list(remaining):
+            if mode == "combined" and not restored[pos]:
+                submit(pos, "combined")
+            else:
+                for key in ANALYSIS_FUNCS:
+                    if key not in restored[pos]:
+                        submit(pos, key)
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                pos, key = pending.pop(future)
+                remaining[pos] -= 1
+                if key == "combined":
+                    try:
+                        sections = future.result()
+                    except Exception:
+                        sections = {}
+                    results[pos].update(sections)
+                    for missing in ANALYSIS_FUNCS:
+                        if missing not in sections:
+                            submit(pos, missing)
+                else:
+                    try:
+                        results[pos][key] = future.result()
+                    except Exception as exc:
+                        errors[pos].append(f"{key}: {type(exc).__name__}: {exc}")
+
+                if remaining[pos] == 0:
+                    if not errors[pos] and journal is not None:
+                        journal.append(rows[pos]["record_id"], results[pos])
+                    yield pos, results[pos], errors[pos]
+    finally:
+        # If the consumer stops early (e.g. a Streamlit rerun), drop queued jobs
+        # instead of blocking until they all finish; the journal keeps what's done.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def apply_ai_results(df, version, completed):
+    """
+    Returns the rows of df whose positions are in completed (pos -> (results, errors)),
+    in their original order, with notes_*_{version} and ai_errors_{version} filled in.
+    """
+    positions = sorted(completed)
+    out = df.iloc[positions].copy()
+    for key in ANALYSIS_FUNCS:
+        out[f"{key}_{version}"] = [completed[pos][0][key] for pos in positions]
+    out[f"ai_errors_{version}"] = ["; ".join(completed[pos][1]) for pos in positions]
+    return out
+
+def run_ai_analysis(df, version, max_workers=None, journal=None, mode=None, reuse=None):
+    """
+    Runs iter_ai_analysis to completion and returns df with notes_*_{version} filled
+    in the original row order and per-row failures in ai_errors_{version}
+    (empty string when every call for the row succeeded).
+    """
+    with metrics.stage("ai_analysis"):
+        completed = {
+            pos: (results, errors)
+            for pos, results, errors in iter_ai_analysis(df, version, max_workers, journal, mode, reuse)
+        }
+    return apply_ai_results(df, version, completed)
+
+def estimate_run_cost(df, version, mode=None, reuse=None):
+    """
+    Projects the prompts a run will send (skipping ones already in the response cache
+    and sections reused from an earlier submission): request count, prompt tokens,
+    worst-case completion tokens and USD cost. Writes nothing, so dry runs can use it.
+    Combined mode is projected without per-section fallbacks.
+    """
+    mode = mode or ANALYSIS_MODE
+    reuse = reuse or {}
+    response_cache = get_response_cache(read_only=True)
+    routes = {section: get_route(section) for section in ("combined", *PROMPT_BUILDERS)}
+
+    request_count = prompt_tokens = completion_tokens = 0
+    for _, row in df.iterrows():
+        reused = reuse.get(row["record_id"], {})
+        if mode == "combined" and not reused:
+            builders = {"combined": build_combined_prompt}
+        else:
+            builders = {key: build for key, build in PROMPT_BUILDERS.items() if key not in reused}
+        for section, build in builders.items():
+            prompt = build(row, version)
+            route = routes[section]
+            if response_cache is not None and response_cache.contains(prompt_hash(prompt, route.model, route.backend)):
+                continue
+            request_count += 1
+            prompt_tokens += count_tokens(prompt)
+            completion_tokens += route.max_tokens
+
+    return cost_projection(request_count, prompt_tokens, completion_tokens)
+
+def cost_projection(request_count, prompt_tokens, completion_tokens):
+    cost = prompt_tokens / 1000 * PROMPT_PRICE_PER_1K + completion_tokens / 1000 * COMPLETION_PRICE_PER_1K
+    return {
+        "requests": request_count,
+        "prompt_tokens": prompt_tokens,
+        "max_completion_tokens": completion_tokens,
+        "max_cost_usd": round(cost, 4),
+    }
+
+def over_budget(projection):
+    """True when a projection from estimate_run_cost exceeds [limits] run_budget_usd."""
+    return bool(RUN_BUDGET_USD) and projection["max_cost_usd"] > RUN_BUDGET_USD
+
+def build_processed_metadata(df, version):
+    """
+    Per-record metadata stored with the processed flag: per-section backends and
+    models, prompt hashes and input fingerprints, so a later resubmission can
+    reuse the sections whose inputs didn't change (their text is read back from
+    the results store).
+    """
+    routes = {key: get_route(key) for key in PROMPT_BUILDERS}
+    backends = {key: route.backend for key, route in routes.items()}
+    models = {key: route.model for key, route in routes.items()}
+    return {
+        row["record_id"]: {
+            "backends": backends,
+            "models": models,
+            "prompt_hashes": {
+                key: prompt_hash(build(row, version), models[key], backends[key])
+                for key, build in PROMPT_BUILDERS.items()
+            },
+            "fingerprints": input_fingerprints(row, version),
+        }
+        for _, row in df.iterrows()
+    }
+
+########################################
+# 12) PROCESS FILE
+########################################
+
+# Export timestamp columns and the display names they are renamed to
+TIMESTAMP_MAPPING = {
+    "documentation_submission_1_timestamp": "peddoclate1",
+    "documentation_submission_2_timestamp": "peddoclate2"
+}
+
+# Rows per chunk in chunked ingestion mode
+DEFAULT_CHUNK_SIZE = 2000
+
+def detect_layout(df):
+    """
+    Returns (version, email_col, timestamp_source) for an export, where
+    timestamp_source is the TIMESTAMP_MAPPING column used to pick each student's
+    latest submission (None if absent). Only df.columns is inspected, so a
+    header-only frame works. Raises PipelineError if a required column is missing.
+    """
+    version = determine_version(df)
+    if version is None:
+        raise PipelineError("No version indicator (_v1 or _v2) found in columns.")
+
+    # Identify email column
+    email_col = next((col for col in df.columns if "email" in col.lower()), None)
+    if not email_col:
+        raise PipelineError("No email column found.")
+
+    # Check if the history of present illness column exists
+    hpi_col = f"historyofpresentillness_{version}"
+    if hpi_col not in df.columns:
+        raise PipelineError(f"Expected column '{hpi_col}' not found.")
+
+    present = [col for col in TIMESTAMP_MAPPING if col in df.columns]
+    return version, email_col, (present[-1] if present else None)
+
+def normalize_records(df, email_col):
+    """
+    Replaces any exported record_id with the student email, moves it to the front
+    and renames the timestamp columns to their display names.
+    """
+    # Remove existing record_id if any
+    if "record_id" in df.columns:
+        df = df.drop(columns=["record_id"])
+    df = df.rename(columns=TIMESTAMP_MAPPING)
+    record_ids = df.pop(email_col).astype(str)
+    df.insert(0, "record_id", record_ids)
+    return df
+
+def parse_submitted_at(values):
+    """Export timestamps (UTC) as minute-resolution US/Eastern datetimes; unparseable values become NaT."""
+    return (
+        pd.to_datetime(values, errors="coerce")
+        .dt.floor("min")
+        .dt.tz_localize("UTC")
+        .dt.tz_convert("US/Eastern")
+    )
+
+def format_submitted_at(submitted_at):
+    return submitted_at.dt.strftime("%m-%d-%Y %H:%M")
+
+def select_latest(record_ids, submitted_at):
+    """Index labels of each record's latest submission, latest first."""
+    order = submitted_at.sort_values(ascending=False, kind="stable").index
+    return record_ids.loc[order].drop_duplicates(keep="first").index
+
+def finish_preparation(df, version):
+    """Word counts, age mapping, line breaks and the combined prompt-context columns, in place."""
+    with metrics.stage("hpi_word_count"):
+        df[f"hpiwords_{version}"] = word_count_column(df[f"historyofpresentillness_{version}"])
+
+    with metrics.stage("preprocess"):
+        # Convert age_{version} to numeric, then map to agex_{version}
+        age_col = f"age_{version}"
+        if age_col in df.columns:
+            df[age_col] = pd.to_numeric(df[age_col], errors="coerce").astype('Int64') 
+            df[f"agex_{version}"] = df[age_col].map(age_mapping)
+
+        # Insert line breaks in certain text columns (like physicalexam_{version}, etc.)
+        text_cols_to_fix = [
+            f"physicalexam_{version}",
+            f"vital_signs_and_growth_{version}",
+            f"historyofpresentillness_{version}"
+            # add more if needed
+        ]
+        for col in text_cols_to_fix:
+            if col in df.columns:
+                df[col] = insert_line_breaks_column(df[col])
+
+    # Build additional columns (like additional_hx_{version}, vital_signs_and_growth_{version})
+    with metrics.stage("build_additional_columns"):
+        build_additional_columns(df, version)
+
+def split_processed(record_ids, version):
+    """
+    Looks up which record_ids are already processed. Returns (done, stored): done
+    is the set marked before fingerprints were stored, which are skipped outright;
+    stored maps the other processed records to their fingerprints, for
+    split_resubmissions once the rows are prepared.
+    """
+    processed = get_processed_fingerprints(record_ids, version)
+    done = {rid for rid, fingerprints in processed.items() if not fingerprints}
+    stored = {rid: fingerprints for rid, fingerprints in processed.items() if fingerprints}
+    return done, stored
+
+def compare_resubmissions(df, version, stored):
+    """
+    Compares prepared rows of already-processed records with their stored input
+    fingerprints. Returns (keep, unchanged): keep masks the new rows and the
+    resubmissions with a changed input, unchanged maps each kept resubmission's
+    record_id to the notes keys whose inputs are the same.
+    """
+    keep = ~df["record_id"].isin(stored)
+    unchanged = {}
+    for idx, row in df[~keep].iterrows():
+        previous = stored[row["record_id"]]
+        current = input_fingerprints(row, version)
+        same = [key for key in current if previous.get(key) == current[key]]
+        if len(same) < len(current):
+            keep[idx] = True
+            unchanged[row["record_id"]] = same
+    return keep, unchanged
+
+def split_resubmissions(df, version, stored):
+    """
+    Drops unchanged resubmissions (compare_resubmissions) and looks up the stored
+    text of the unchanged sections of changed ones, to reuse.
+    Returns (df, reuse) with reuse mapping record_id -> {notes key: text}.
+    """
+    if not df["record_id"].isin(stored).any():
+        return df, {}
+
+    keep, unchanged = compare_resubmissions(df, version, stored)
+    sections = get_stored_sections(unchanged, version) if unchanged else {}
+    reuse = {}
+    for rid, same in unchanged.items():
+        saved = sections.get(rid, {})
+        reuse[rid] = {key: saved[key] for key in same if key in saved}
+    metrics.incr("records_resubmitted", len(unchanged))
+    metrics.incr("sections_reused", sum(len(sections) for sections in reuse.values()))
+    return df[keep], reuse
+
+# An upload ready for AI analysis; resumed counts rows restored from its checkpoint
+# journal and reuse holds the unchanged sections of resubmitted records
+PreparedUpload = namedtuple("PreparedUpload", ["df", "version", "journal", "resumed", "reuse"])
+
+def prepare_upload(data):
+    """
+    Reads CSV bytes as strings, determines version, keeps each student's latest
+    submission, filters out processed records, inserts line breaks and builds
+    dynamic columns. Processed records whose prompt inputs changed since are kept
+    for re-analysis of just the affected sections.
+    Returns a PreparedUpload, or None if every record was already processed.
+    Raises PipelineError if the file is missing a required column.
+    """
+    # 1) Read all as strings to preserve "1" as "1"
+    #df = pd.read_csv(uploaded_file, dtype=str)
+    with metrics.stage("read_csv"):
+        df = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False,na_filter=False)
+    metrics.incr("rows_in", len(df))
+
+    # 2) Determine version and key columns, then key rows by student email
+    version, email_col, timestamp_source = detect_layout(df)
+    df = normalize_records(df, email_col)
+    timestamp_col = TIMESTAMP_MAPPING.get(timestamp_source)
+
+    # 3) Timestamps: parse once, keep each student's latest submission, and only
+    # then spend Firestore round trips and preprocessing on the unique records
+    if timestamp_col:
+        with metrics.stage("latest_submission"):
+            submitted_at = parse_submitted_at(df[timestamp_col])
+            latest = select_latest(df["record_id"], submitted_at)
+            df, submitted_at = df.loc[latest], submitted_at.loc[latest]
+
+    # 4) Filter out processed records that can't have changed
+    with metrics.stage("dedup"):
+        done, stored = split_processed(df["record_id"].tolist(), version)
+        keep = ~df["record_id"].isin(done)
+        df = df[keep]
+    if df.empty:
+        metrics.incr("rows_out", 0)
+        return None
+
+    # 5) Format timestamps for display
+    if timestamp_col:
+        with metrics.stage("timestamps"):
+            df[f"submitted_at_{version}"] = submitted_at[keep]
+            df[timestamp_col] = format_submitted_at(submitted_at[keep])
+
+    # 6) Word counts, ages, line breaks and additional columns
+    finish_preparation(df, version)
+
+    # 7) Drop unchanged resubmissions; changed ones reuse their unchanged sections
+    with metrics.stage("resubmissions"):
+        df, reuse = split_resubmissions(df, version, stored)
+    if df.empty:
+        metrics.incr("rows_out", 0)
+        return None
+
+    # 8) Open the checkpoint journal for this upload
+    with metrics.stage("journal"):
+        journal = journal_for_upload(data)
+        resumed = int(df["record_id"].isin(journal.completed_ids()).sum())
+    if resumed:
+        logger.info("Resuming from checkpoint: %d record(s) already analyzed.", resumed)
+    metrics.incr("rows_out", len(df))
+
+    return PreparedUpload(df, version, journal, resumed, reuse)
+
+def finalize_upload(df, version, journal):
+    """
+    Saves successfully analyzed rows to the results store, marks their records
+    processed and drops their checkpoint entries, which Firestore now covers.
+    The order matters: a record is only flagged once its result is stored, and
+    only forgotten once flagged, so a failure in between leaves it to be retried
+    (from the journal) instead of dropped as an unchanged resubmission.
+    Returns the number of records left unmarked because of AI errors.
+    """
+    # Rows with a failed call stay unmarked so a re-upload retries them
+    failed = df[f"ai_errors_{version}"] != ""
+    if failed.any():
+        logger.warning("%d record(s) had AI errors and were not marked processed.", int(failed.sum()))
+    done = df.loc[~failed]
+    with metrics.stage("store_results"):
+        store_results(done, version)
+    with metrics.stage("mark_processed"):
+        mark_records_as_processed_version(done["record_id"], version, build_processed_metadata(done, version))
+    journal.forget(done["record_id"])
+    return int(failed.sum())
+
+def read_source(source):
+    """Returns the bytes of a path, raw bytes, or a file-like object (e.g. a Streamlit upload)."""
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as fh:
+            return fh.read()
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    return source.read()
+
+def process_file(source, mode=None, max_workers=None):
+    """
+    Reads and prepares the upload, runs dynamic AI analysis (checkpointed per row,
+    resuming a previous attempt on the same file), marks records processed,
+    returns (df, version), or None if there was nothing to process.
+    """
+    prepared = prepare_upload(read_source(source))
+    if prepared is None:
+        return None
+    df, version, journal, _, reuse = prepared
+
+    logger.info("Running AI analysis for %s on %d record(s)", version, len(df))
+    df = run_ai_analysis(df, version, max_workers=max_workers, journal=journal, mode=mode, reuse=reuse)
+    finalize_upload(df, version, journal)
+
+    return df, version
+
+# A chunked upload after the key pass: rows holds the CSV row numbers still to analyze
+# and stored the fingerprints of those that are resubmissions of processed records
+ChunkedUpload = namedtuple(
+    "ChunkedUpload",
+    ["source", "version", "email_col", "timestamp_source", "rows", "stored", "journal", "chunksize"]
+)
+
+def read_csv_chunks(source, chunksize, usecols=None):
+    """Iterates a CSV path or seekable file-like object as string DataFrames of chunksize rows."""
+    if not isinstance(source, (str, os.PathLike)):
+        source.seek(0)
+    return pd.read_csv(
+        source, dtype=str, keep_default_na=False, na_filter=False,
+        chunksize=chunksize, usecols=usecols
+    )
+
+def prepare_chunked_upload(source, chunksize=None):
+    """
+    Key pass for chunked ingestion: reads only the email and timestamp columns
+    chunk by chunk, keeps each student's latest submission and filters out
+    processed records, without holding the free-text columns in memory.
+    source must be a path or a seekable file-like object (it is read twice).
+    Returns a ChunkedUpload, or None if every record was already processed.
+    Raises PipelineError if the file is missing a required column.
+    """
+    chunksize = chunksize or DEFAULT_CHUNK_SIZE
+    if not isinstance(source, (str, os.PathLike)):
+        source.seek(0)
+    header = pd.read_csv(source, dtype=str, nrows=0)
+    version, email_col, timestamp_source = detect_layout(header)
+
+    usecols = [email_col] + ([timestamp_source] if timestamp_source else [])
+    with metrics.stage("latest_submission"):
+        keys = []
+        with read_csv_chunks(source, chunksize, usecols=usecols) as reader:
+            for chunk in reader:
+                key = pd.DataFrame({"record_id": chunk[email_col].astype(str)}, index=chunk.index)
+                if timestamp_source:
+                    key["submitted_at"] = parse_submitted_at(chunk[timestamp_source])
+                keys.append(key)
+        metrics.incr("rows_in", sum(len(key) for key in keys))
+        if not keys:
+            metrics.incr("rows_out", 0)
+            return None
+        keys = pd.concat(keys)
+        if timestamp_source:
+            keys = keys.loc[select_latest(keys["record_id"], keys["submitted_at"])]
+
+    with metrics.stage("dedup"):
+        done, stored = split_processed(keys["record_id"].tolist(), version)
+        keys = keys[~keys["record_id"].isin(done)]
+    if keys.empty:
+        metrics.incr("rows_out", 0)
+        return None
+
+    with metrics.stage("journal"):
+        journal = open_journal(source_hash(source))
+    return ChunkedUpload(
+        source, version, email_col, timestamp_source, frozenset(keys.index), stored, journal, chunksize
+    )
+
+def iter_prepared_chunks(prepared):
+    """Yields each chunk of a ChunkedUpload's selected rows, keyed and preprocessed, in file order."""
+    version = prepared.version
+    timestamp_col = TIMESTAMP_MAPPING.get(prepared.timestamp_source)
+    with read_csv_chunks(prepared.source, prepared.chunksize) as reader:
+        for chunk in reader:
+            chunk = chunk[chunk.index.isin(prepared.rows)]
+            if chunk.empty:
+                continue
+
+            df = normalize_records(chunk, prepared.email_col)
+            if timestamp_col:
+                with metrics.stage("timestamps"):
+                    df[f"submitted_at_{version}"] = parse_submitted_at(df[timestamp_col])
+                    df[timestamp_col] = format_submitted_at(df[f"submitted_at_{version}"])
+            finish_preparation(df, version)
+            yield df
+
+def estimate_chunked_cost(prepared, mode=None):
+    """
+    estimate_run_cost for a ChunkedUpload, projected chunk by chunk so memory stays
+    bounded. Costs an extra read and preprocessing pass over the file, but no API
+    calls or writes; the sections a resubmission keeps are taken from the stored
+    fingerprints without fetching their text.
+    """
+    totals = {"requests": 0, "prompt_tokens": 0, "max_completion_tokens": 0}
+    with metrics.stage("estimate_cost"):
+        for df in iter_prepared_chunks(prepared):
+            keep, unchanged = compare_resubmissions(df, prepared.version, prepared.stored)
+            projection = estimate_run_cost(df[keep], prepared.version, mode, unchanged)
+            for key in totals:
+                totals[key] += projection[key]
+    return cost_projection(totals["requests"], totals["prompt_tokens"], totals["max_completion_tokens"])
+
+def iter_chunked_upload(prepared, output_path, mode=None, max_workers=None):
+    """
+    Preprocesses, analyzes and marks each chunk of a ChunkedUpload in turn and
+    appends its rows to the CSV at output_path, so only one chunk is in memory.
+    Rows are written in file order. Yields (rows_done, rows_total, rows_written,
+    failed) after each chunk; rows_done also counts unchanged resubmissions, which
+    are dropped. Journal entries are dropped as their rows are marked processed.
+    """
+    version = prepared.version
+    total = len(prepared.rows)
+    done = written = failed = 0
+
+    for df in iter_prepared_chunks(prepared):
+        done += len(df)
+        with metrics.stage("resubmissions"):
+            df, reuse = split_resubmissions(df, version, prepared.stored)
+        if df.empty:
+            yield done, total, written, failed
+            continue
+
+        df = run_ai_analysis(
+            df, version, max_workers=max_workers, journal=prepared.journal, mode=mode, reuse=reuse
+        )
+        failed += finalize_upload(df, version, prepared.journal)
+
+        with metrics.stage("write_output"):
+            df.to_csv(
+                output_path, columns=output_columns(df, version), mode="a" if written else "w",
+                header=not written, index=False, chunksize=CSV_WRITE_CHUNK_ROWS
+            )
+        written += len(df)
+        metrics.incr("rows_out", len(df))
+        yield done, total, written, failed
+
+def process_file_chunked(source, output_path, chunksize=None, mode=None, max_workers=None):
+    """
+    Chunked counterpart of process_file for exports too large to hold in memory:
+    writes the processed rows as CSV to output_path and returns (rows, version),
+    or None if there was nothing to process (output_path is then not written).
+    """
+    prepared = prepare_chunked_upload(source, chunksize)
+    if prepared is None:
+        return None
+
+    logger.info(
+        "Running chunked AI analysis for %s on %d record(s), %d row(s) per chunk",
+        prepared.version, len(prepared.rows), prepared.chunksize
+    )
+    written = 0
+    for done, total, written, failed in iter_chunked_upload(prepared, output_path, mode=mode, max_workers=max_workers):
+        logger.info("Chunk done: %d/%d record(s), %d written, %d failed", done, total, written, failed)
+    if not written:
+        return None
+    return written, prepared.version
+
+########################################
+# 13) OUTPUT
+########################################
+
+def output_columns(df, version):
+    """Columns written to downloads/exports: everything but the prompt-only and hidden helper columns."""
+    columns_to_remove = {
+        f"additional_hx_{version}",
+        f"vital_signs_and_growth_{version}",
+        f"agex_{version}",
+        f"submitted_at_{version}"
+    }
+    return [col for col in df.columns if col not in columns_to_remove]
+
+# Export formats and their MIME types
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+# Rows pandas formats per write, bounding the CSV writer's buffer
+CSV_WRITE_CHUNK_ROWS = 500
+
+# XLSX column widths (characters) for the feedback columns and everything else
+XLSX_FEEDBACK_WIDTH = 80
+XLSX_COLUMN_WIDTH = 20
+
+@contextlib.contextmanager
+def _binary_output(path):
+    """Yields a binary handle for a file path, or the given binary buffer itself."""
+    if isinstance(path, (str, os.PathLike)):
+        with open(path, "wb") as fh:
+            yield fh
+    else:
+        yield path
+
+def _write_csv(chunks, version, path):
+    with _binary_output(path) as fh:
+        for i, df in enumerate(chunks):
+            # columns= writes the selection directly instead of copying it first
+            df.to_csv(
+                fh, columns=output_columns(df, version), header=i == 0, index=False,
+                encoding="utf-8", chunksize=CSV_WRITE_CHUNK_ROWS
+            )
+
+def _write_parquet(chunks, version, path):
+    if pyarrow is None:
+        raise PipelineError("Parquet export needs pyarrow (pip install pyarrow).")
+    writer = None
+    try:
+        for df in chunks:
+            table = pyarrow.Table.from_pandas(df, columns=output_columns(df, version), preserve_index=False)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path, table.schema, compression="zstd")
+            writer.write_table(table.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+def _write_xlsx(chunks, version, path):
+    # constant_memory flushes each row to disk as it is written; strings are never
+    # reinterpreted as formulas, URLs or numbers
+    workbook = xlsxwriter.Workbook(path, {
+        "constant_memory": True,
+        "strings_to_formulas": False,
+        "strings_to_urls": False,
+        "strings_to_numbers": False,
+    })
+    try:
+        worksheet = workbook.add_worksheet(f"processed_{version}")
+        header = workbook.add_format({"bold": True, "valign": "top"})
+        wrapped = workbook.add_format({"text_wrap": True, "valign": "top"})
+        plain = workbook.add_format({"valign": "top"})
+
+        row_num = 0
+        formats = None
+        for df in chunks:
+            columns = output_columns(df, version)
+            if formats is None:
+                feedback = {f"{key}_{version}" for key in PROMPT_BUILDERS} | {f"ai_errors_{version}"}
+                formats = [wrapped if col in feedback else plain for col in columns]
+                for col_num, col in enumerate(columns):
+                    width = XLSX_FEEDBACK_WIDTH if col in feedback else XLSX_COLUMN_WIDTH
+                    worksheet.set_column(col_num, col_num, width)
+                worksheet.write_row(0, 0, columns, header)
+                worksheet.freeze_panes(1, 0)
+            for values in df[columns].itertuples(index=False, name=None):
+                row_num += 1
+                for col_num, value in enumerate(values):
+                    if not pd.isna(value):
+                        worksheet.write(row_num, col_num, value, formats[col_num])
+    finally:
+        workbook.close()
+
+_WRITERS = {"csv": _write_csv, "parquet": _write_parquet, "xlsx": _write_xlsx}
+
+def write_output_chunks(chunks, version, path, fmt="csv"):
+    """
+    Writes an iterable of processed-row DataFrames as one export to path (a file
+    path or a binary buffer) as "csv", "parquet" or "xlsx", holding only one chunk
+    at a time. XLSX uses xlsxwriter's constant-memory mode with the feedback
+    columns wrapped; Parquet needs pyarrow and is zstd-compressed.
+    """
+    if fmt not in _WRITERS:
+        raise ValueError(f"Unknown export format '{fmt}'; expected one of {', '.join(EXPORT_FORMATS)}.")
+    _WRITERS[fmt](chunks, version, path)
+
+def write_output(df, version, path, fmt="csv"):
+    """Writes the processed rows to path as "csv", "parquet" or "xlsx"."""
+    write_output_chunks([df], version, path, fmt)
+
+def export_buffer(df, version, fmt="csv"):
+    """
+    The processed rows as an export file in a BytesIO rewound to the start, e.g.
+    for a download button (returning the buffer avoids a getvalue() copy).
+    """
+    buffer = io.BytesIO()
+    write_output(df, version, buffer, fmt)
+    buffer.seek(0)
+    return buffer
+
+def convert_output(csv_path, version, path, fmt, chunksize=None):
+    """Re-encodes a CSV written by the chunked mode as another format, one chunk at a time."""
+    with read_csv_chunks(csv_path, chunksize or DEFAULT_CHUNK_SIZE) as reader:
+        write_output_chunks(reader, version, path, fmt)